@@ -1,14 +1,15 @@
 import streamlit as st
-import google.generativeai as genai
-from docx import Document
 from streamlit_mermaid import st_mermaid
 from audio_recorder_streamlit import audio_recorder
-import tempfile
-import os
 import time
-import mimetypes
-import re
-import random
+import uuid
+from jobs import ACTIVE_STATUSES, get_job_manager, job_progress, job_text
+from pipeline import (
+    ANALYSIS_SECTIONS, DEFAULT_FALLBACK_MODELS, EXPORTERS, METRICS_LOG_PATH, SEGMENT_MINUTES,
+    SEGMENT_WORKERS, KeyPool, RunMetrics, TranscriptIndex, TranscriptStore, answer_from_transcript, build_chat_turns,
+    collect_metrics, content_digest, ensure_context_cache, format_model_name, generate_with_context, get_key_pool,
+    get_optimized_models, get_response_store, preprocess_audio, remap_timestamps, run_export, timed,
+)
 
 # --- 1. CẤU HÌNH TRANG ---
 st.set_page_config(page_title="Universal AI Studio (Ultimate)", page_icon="💎", layout="wide")
@@ -21,76 +22,166 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
-# --- 2. BIẾN TOÀN CỤC ---
-STRICT_RULES = "CHỈ DÙNG FILE GỐC. CẤM BỊA TÊN DIỄN GIẢ. CẤM BỊA NỘI DUNG. TRÍCH DẪN GIỜ [mm:ss]."
+# --- 2. HÀM HỖ TRỢ GIAO DIỆN ---
+SEGMENTS_PER_PAGE = 150      # số đoạn hiển thị mỗi trang khi bản gỡ băng dài
+JOB_POLL_SECONDS = 1         # chu kỳ làm mới danh sách job (và phần đang sinh) khi còn job đang chạy
+JOB_ICONS = {"queued": "⏳", "running": "🔄", "done": "✅", "error": "❌", "cancelled": "⏹️", "interrupted": "⏸️"}
 
-# --- 3. QUẢN LÝ SESSION ---
-if "chat_history" not in st.session_state: st.session_state.chat_history = []
-if "gemini_files" not in st.session_state: st.session_state.gemini_files = [] 
-if "analysis_result" not in st.session_state: st.session_state.analysis_result = ""
-if "is_auto_running" not in st.session_state: st.session_state.is_auto_running = False
-if "loop_count" not in st.session_state: st.session_state.loop_count = 0
-# Biến phục vụ Retry
-if "quota_error" not in st.session_state: st.session_state.quota_error = False
-if "last_prompt" not in st.session_state: st.session_state.last_prompt = ""
-if "last_config" not in st.session_state: st.session_state.last_config = None
-
-# --- 4. HÀM HỖ TRỢ ---
-def get_system_key():
+def get_system_keys():
     try:
         if "SYSTEM_KEYS" in st.secrets:
             keys = st.secrets["SYSTEM_KEYS"]
             if isinstance(keys, str): 
                 keys = [k.strip() for k in keys.replace('[','').replace(']','').replace('"','').replace("'",'').split(',')]
-            return random.choice(keys)
+            return list(keys)
         elif "GOOGLE_API_KEY" in st.secrets:
-            return st.secrets["GOOGLE_API_KEY"]
-    except: return None
+            return [st.secrets["GOOGLE_API_KEY"]]
+    except: pass
+    return []
 
-def configure_genai(user_key=None):
-    api_key = user_key if user_key else get_system_key()
-    if not api_key: return False
-    try:
-        genai.configure(api_key=api_key)
-        return True
-    except: return False
-
-def get_optimized_models():
-    # Danh sách cứng để đảm bảo luôn có lựa chọn
-    return ["models/gemini-3.0-flash-preview", "models/gemini-2.0-flash-exp", "models/gemini-1.5-flash", "models/gemini-1.5-pro"]
-
-def format_model_name(name):
-    return name.replace("models/", "").replace("-preview", " (Pre)").replace("-latest", "").upper()
-
-def upload_to_gemini(path):
-    mime_type, _ = mimetypes.guess_type(path)
-    file = genai.upload_file(path, mime_type=mime_type or "application/octet-stream")
-    while file.state.name == "PROCESSING":
-        time.sleep(1)
-        file = genai.get_file(file.name)
-    return file
-
-def create_docx(content):
-    doc = Document()
-    doc.add_heading('BÁO CÁO', 0)
-    clean_content = content.replace("```markdown", "").replace("```", "")
-    for line in clean_content.split('\n'):
-        if line.startswith('# '): doc.add_heading(line.replace('# ', ''), level=1)
-        elif line.startswith('## '): doc.add_heading(line.replace('## ', ''), level=2)
-        elif line.startswith('### '): doc.add_heading(line.replace('### ', ''), level=3)
-        else: doc.add_paragraph(line)
-    return doc
-
-def get_safe_response(response):
-    try:
-        finish_reason = response.candidates[0].finish_reason
-        if finish_reason in [1, 2]: return response.text
-        elif finish_reason == 3: return "\n\n[CẢNH BÁO: Nội dung bị chặn do Safety.]"
-        elif finish_reason == 4: return "\n\n[DỪNG: Phát hiện nội dung có bản quyền.]"
-        else: return f"\n\n[Lỗi: Finish Reason {finish_reason}]"
-    except: return response.text
-
-# --- 5. MAIN APP ---
+def get_system_key():
+    pool = get_key_pool()
+    pool.set_keys(get_system_keys())
+    return pool.best_key()
+
+def has_api_key(user_key=None):
+    # Không gọi genai.configure ở đây: mọi request tự gắn key qua KeyPool (khóa chung GENAI_LOCK),
+    # cấu hình toàn cục theo key của session này có thể lọt sang job của người khác.
+    return bool(user_key or get_system_key())
+
+def get_session_pool(user_key=None):
+    # Key riêng của người dùng: pool riêng trong session. Không thì dùng pool chung của hệ thống.
+    if user_key:
+        if st.session_state.get("user_pool_key") != user_key:
+            st.session_state.user_pool = KeyPool([user_key])
+            st.session_state.user_pool_key = user_key
+        return st.session_state.user_pool
+    pool = get_key_pool()
+    pool.set_keys(get_system_keys())
+    return pool
+
+def render_segments(segments, key, cut_list=None):
+    # Chỉ vẽ một trang để chi phí mỗi lần rerun không tăng theo độ dài bản gỡ băng
+    pages = max(1, -(-len(segments) // SEGMENTS_PER_PAGE))
+    page = pages
+    if pages > 1:
+        page = st.number_input(f"Trang (/{pages}):", 1, pages, pages, key=f"page_{key}")
+    chunk = segments[(page - 1) * SEGMENTS_PER_PAGE: page * SEGMENTS_PER_PAGE]
+    st.markdown(remap_timestamps("\n\n".join(seg["raw"] for seg in chunk), cut_list))
+
+def get_owner():
+    # Mã người dùng nằm trên URL (?u=...): đóng tab rồi mở lại đúng link vẫn thấy các job của mình
+    if "u" not in st.query_params: st.query_params["u"] = uuid.uuid4().hex[:16]
+    return st.query_params["u"]
+
+def open_job(job):
+    # Nạp kết quả (hoặc phần đã xong) của job vào session để xem, xuất file và chat
+    st.session_state.transcript.replace(job_text(job))
+    st.session_state.cut_list = job["state"].get("cut_list")
+    st.session_state.prep_notes = job["state"].get("prep_notes", [])
+    st.session_state.open_job, st.session_state.open_version = job["id"], job["version"]
+    st.session_state.gemini_files, st.session_state.file_digests = [], []   # nạp lười khi chat
+    st.session_state.chat_history, st.session_state.context_cache = [], None
+    st.session_state.export_request = None
+
+def refresh_open_job(job):
+    # Job đang mở vẫn chạy tiếp: chỉ nối phần mới vào transcript (chỉ mục chat cũng chỉ thêm đoạn mới), giữ nguyên chat
+    text, transcript = job_text(job), st.session_state.transcript
+    if transcript.text and text.startswith(transcript.text): transcript.append(text[len(transcript.text):].lstrip("\n"))
+    else: transcript.replace(text)
+    st.session_state.cut_list = job["state"].get("cut_list")
+    st.session_state.prep_notes = job["state"].get("prep_notes", [])
+    st.session_state.open_version = job["version"]
+
+def render_jobs(key_pool, model_chain, store, polling):
+    # Chạy trong st.fragment: mỗi lần poll chỉ vẽ lại khối này. Nút nào đổi kết quả đang mở thì rerun cả trang.
+    manager = get_job_manager()
+    jobs = manager.list(get_owner())
+    follow = manager.get(st.session_state.follow_job) if st.session_state.follow_job else None
+    if follow and follow["status"] == "done":
+        # Mở một lần rồi thôi theo dõi, để bấm "Mở" job khác không bị kéo ngược về job này
+        st.session_state.follow_job = None
+        if st.session_state.open_job != follow["id"]: open_job(follow); st.rerun()
+    opened = manager.get(st.session_state.open_job) if st.session_state.open_job else None
+    if opened and opened["version"] != st.session_state.open_version: refresh_open_job(opened)
+    if polling and not any(j["status"] in ACTIVE_STATUSES for j in jobs):
+        st.rerun()   # job cuối cùng vừa dừng: vẽ lại cả trang để tắt poll
+    if not jobs: return
+    st.subheader("🗂️ Công việc")
+    for job in jobs:
+        done, total = job_progress(job)
+        with st.container(border=True):
+            c1, c2 = st.columns([4, 1])
+            kind = "Gỡ băng" if job["params"]["mode"] == "transcribe" else "Phân tích"
+            c1.markdown(f"{JOB_ICONS[job['status']]} **{job['title']}** · {kind} · {time.strftime('%d/%m %H:%M', time.localtime(job['created']))}")
+            if total: c1.progress(done / total, text=f"{done}/{total} {'đoạn' if 'windows' in job['state'] else 'mục'}")
+            elif done: c1.caption(f"{done} vòng")
+            if job["error"]: c1.caption(f"⚠️ {job['error'][:200]}")
+            for name, status in job["live"]["uploads"].items(): c1.caption(f"📤 {name}: {status}")
+            if (job["status"] == "done" or done) and c2.button("📂 Mở", key=f"open_{job['id']}"):
+                st.session_state.follow_job = None; open_job(job); st.rerun()
+            if job["status"] in ACTIVE_STATUSES:
+                if c2.button("🛑 Hủy", key=f"cancel_{job['id']}"): manager.cancel(job["id"])
+            else:
+                if job["status"] != "done" and c2.button("🔁 Chạy tiếp", key=f"resume_{job['id']}", disabled=not model_chain):
+                    manager.resume(job["id"], key_pool, model_chain, store)
+                    st.session_state.follow_job = job["id"]; st.rerun()
+                if c2.button("🗑️ Xóa", key=f"del_{job['id']}"):
+                    manager.delete(job["id"]); st.rerun()
+            # Job đang theo dõi: hiện phần mới nhất ngay khi có
+            if job["id"] == st.session_state.follow_job and job["status"] in ACTIVE_STATUSES:
+                if done: st.markdown(remap_timestamps(job_text(job)[-1500:], job["state"].get("cut_list")))
+                # Phần đang sinh (bật Streaming): cập nhật mỗi lần poll, chưa vào kết quả cho tới khi đoạn/mục xong
+                for label, live in job["live"]["streams"].items():
+                    st.caption(f"✍️ {label} · token đầu tiên sau {live['ttft']:.1f}s")
+                    st.markdown(remap_timestamps(live["text"], job["state"].get("cut_list")))
+
+@st.cache_data(max_entries=16, show_spinner=False)
+def preprocess_audio_cached(digest, name, _data, trim=True):
+    # Tham số có "_" không bị Streamlit hash: khóa cache chỉ là digest + tên + trim
+    return preprocess_audio(name, _data, trim=trim)
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def export_artifact(fmt, content_hash, _transcript, _cut_list=None):
+    # Nhớ theo hash nội dung (dùng chung mọi session); chỉ gọi khi người dùng bấm xuất
+    return run_export(fmt, _transcript, _cut_list)
+
+def render_metrics(summary):
+    tokens, counters = summary["tokens"], summary["counters"]
+    c1, c2, c3, c4 = st.columns(4)
+    c1.metric("Thời gian", f"{summary['elapsed']:.1f}s")
+    c2.metric("Request", summary["requests"])
+    c3.metric("Token vào/ra", f"{tokens['prompt']:,}/{tokens['output']:,}")
+    c4.metric("Retry/Fallback", f"{counters['retries']}/{counters['fallbacks']}")
+    if summary["stages"]:
+        st.dataframe([{"Giai đoạn": k, "Số lần": v["count"], "Tổng (s)": v["seconds"], "TB (s)": round(v["seconds"] / v["count"], 3),
+                       "Lâu nhất (s)": v["max"]} for k, v in sorted(summary["stages"].items(), key=lambda x: -x[1]["seconds"])], hide_index=True)
+    if summary["calls"]:
+        # Mỗi request một dòng: thấy được chi phí token của từng vòng chạy tiếp / từng câu chat
+        st.dataframe([{"#": i + 1, "Model": format_model_name(c["model"]), "Qua": c["via"], "Thời gian (s)": c["seconds"],
+                       "TTFT (s)": c["ttft"], "Token vào": c["prompt"], "Token ra": c["output"], "Từ cache": c["cached"]}
+                      for i, c in enumerate(summary["calls"])], hide_index=True)
+    st.caption(" · ".join(f"{k}: {v}" for k, v in counters.items()))
+
+# --- 3. QUẢN LÝ SESSION ---
+if "chat_history" not in st.session_state: st.session_state.chat_history = []
+if "gemini_files" not in st.session_state: st.session_state.gemini_files = [] 
+if "file_digests" not in st.session_state: st.session_state.file_digests = []
+if "transcript" not in st.session_state: st.session_state.transcript = TranscriptStore()
+# Job nền: job đang mở trong phần kết quả, job vừa gửi (tự mở khi xong)
+if "open_job" not in st.session_state: st.session_state.open_job = None
+if "open_version" not in st.session_state: st.session_state.open_version = None
+if "chat_index" not in st.session_state: st.session_state.chat_index = TranscriptIndex()
+if "follow_job" not in st.session_state: st.session_state.follow_job = None
+if "rescue_key" not in st.session_state: st.session_state.rescue_key = ""
+if "context_cache" not in st.session_state: st.session_state.context_cache = None
+if "cut_list" not in st.session_state: st.session_state.cut_list = None
+if "export_request" not in st.session_state: st.session_state.export_request = None
+if "prep_notes" not in st.session_state: st.session_state.prep_notes = []
+if "cache_stats" not in st.session_state: st.session_state.cache_stats = {"hits": 0, "misses": 0, "saved_tokens": 0}
+if "ui_metrics" not in st.session_state: st.session_state.ui_metrics = RunMetrics("ui")
+
+# --- 4. MAIN APP ---
 def main():
     st.title("💎 Universal AI Studio (Ultimate)")
     
@@ -99,6 +190,14 @@ def main():
         st.header("🎯 CHẾ ĐỘ")
         main_mode = st.radio("Mục tiêu:", ("📝 Gỡ băng nguyên văn", "📊 Phân tích chuyên sâu"))
         
+        seg_mode = False
+        if main_mode == "📝 Gỡ băng nguyên văn":
+            seg_mode = st.checkbox("⚡ Gỡ băng song song (chia đoạn)", True,
+                                   help="Chỉ áp dụng khi tải lên đúng một file audio/video, cần ffmpeg để đo và cắt file; nhiều file hoặc không cắt được thì tự gỡ một lượt + chạy tiếp.")
+            if seg_mode:
+                seg_minutes = st.slider("Độ dài mỗi đoạn (phút):", 2, 30, SEGMENT_MINUTES)
+                seg_workers = st.slider("Số đoạn chạy cùng lúc:", 1, 8, SEGMENT_WORKERS)
+
         if main_mode == "📊 Phân tích chuyên sâu":
             st.subheader("KHO VŨ KHÍ (FULL):")
             
@@ -123,28 +222,52 @@ def main():
             st.markdown("**4. Dữ liệu**")
             opt_slides = st.checkbox("🖥️ Dàn ý Slide", False)
             opt_table = st.checkbox("📉 Bảng số liệu", False)
+
+            opt_fanout = st.checkbox("🧩 Chạy từng mục song song", True)
         
         st.divider()
         
         with st.expander("⚙️ Cấu hình & Key", expanded=True):
-            initial_key = st.text_input("Key riêng (Tùy chọn):", type="password")
-            if configure_genai(initial_key):
-                st.success("Đã kết nối!")
+            initial_key = st.text_input("Key riêng (Tùy chọn):", type="password") or st.session_state.rescue_key
+            use_stream = st.toggle("⚡ Hiện chữ ngay khi sinh (Streaming)", True)
+            use_memo = st.toggle("💾 Dùng lại kết quả đã lưu", True)
+            store = get_response_store() if use_memo else None
+            use_prep = st.toggle("🎚️ Nén audio & cắt khoảng lặng", False)
+            show_diag = st.toggle("🩺 Hiện chẩn đoán", False)
+            key_pool = get_session_pool(initial_key)
+            model_chain, detail_level = [], "Sâu"   # rỗng = chưa kết nối: chưa cho chạy job
+            if has_api_key(initial_key):
+                st.success(f"Đã kết nối! ({len(key_pool.keys)} key)")
                 models = get_optimized_models()
                 model_version = st.selectbox("Engine:", models, index=0, format_func=format_model_name)
+                fallback_models = st.multiselect("Model dự phòng (theo thứ tự):", models, default=DEFAULT_FALLBACK_MODELS, format_func=format_model_name)
+                model_chain = [model_version] + [m for m in fallback_models if m != model_version]
                 if main_mode.startswith("📊"):
                     detail_level = st.select_slider("Chi tiết:", ["Sơ lược", "Tiêu chuẩn", "Sâu"], value="Sâu")
             else: st.error("Chưa kết nối!")
 
+        with st.expander("💾 Bộ nhớ kết quả"):
+            mstats = get_response_store().stats()
+            st.caption(f"Hit: {mstats['hits']} · Miss: {mstats['misses']} · {mstats['entries']} kết quả ({mstats['bytes'] / 1e6:.1f} MB)")
+            if st.button("🧹 Xóa bộ nhớ"):
+                get_response_store().clear(); st.rerun()
+
+        with st.expander("📡 Trạng thái Key"):
+            rows = key_pool.snapshot()
+            if rows: st.dataframe(rows, hide_index=True)
+            else: st.caption("Chưa có request nào.")
+
         if st.button("🗑️ Reset"):
             st.session_state.clear(); st.rerun()
 
     # --- XỬ LÝ LỖI QUOTA (INTERACTIVE) ---
-    if st.session_state.quota_error:
+    manager = get_job_manager()
+    quota_jobs = [j for j in manager.list(get_owner()) if j["status"] == "error" and j["quota"]]
+    if quota_jobs:
         st.markdown("""
         <div class="error-box">
             <h3>⚠️ HẾT HẠN MỨC (429 QUOTA EXCEEDED)</h3>
-            <p>Model bạn chọn đã hết lượt dùng miễn phí. Bạn muốn xử lý sao?</p>
+            <p>Model bạn chọn đã hết lượt dùng miễn phí. Phần đã xong vẫn được giữ, bạn muốn chạy tiếp thế nào?</p>
         </div>
         """, unsafe_allow_html=True)
         
@@ -152,245 +275,147 @@ def main():
         with c1:
             rescue_key = st.text_input("🔑 Nhập API Key MỚI để tiếp tục:", type="password", key="rescue")
             if st.button("🚀 Thử lại với Key này"):
-                if configure_genai(rescue_key):
-                    st.session_state.quota_error = False
+                if has_api_key(rescue_key):
+                    st.session_state.rescue_key = rescue_key
+                    chain = model_chain or get_optimized_models()[:1] + DEFAULT_FALLBACK_MODELS
+                    for j in quota_jobs: manager.resume(j["id"], get_session_pool(rescue_key), chain, store)
                     st.rerun() # Chạy lại với key mới
         with c2:
             st.write("Hoặc:")
             if st.button("⬇️ Hạ xuống 1.5 Flash (Miễn phí)"):
-                st.session_state.quota_error = False
-                with st.spinner("Đang chuyển sang 1.5 Flash..."):
-                    try:
-                        # Hạ cấp model
-                        model = genai.GenerativeModel("models/gemini-1.5-flash")
-                        response = model.generate_content([st.session_state.last_prompt] + st.session_state.gemini_files, generation_config=st.session_state.last_config)
-                        st.session_state.analysis_result = get_safe_response(response)
-                        st.rerun()
-                    except Exception as e: st.error(f"Lỗi: {e}")
+                for j in quota_jobs: manager.resume(j["id"], key_pool, DEFAULT_FALLBACK_MODELS, store)
+                st.rerun()
         st.divider()
 
     # --- TABS ---
     tab_work, tab_chat = st.tabs(["📂 Xử lý", "💬 Chat"])
 
     with tab_work:
-        if not st.session_state.quota_error:
-            up_files = st.file_uploader("Upload file", accept_multiple_files=True)
-            audio_bytes = audio_recorder()
-
-            if st.button("🚀 BẮT ĐẦU", type="primary"):
-                temp_paths = []
-                if up_files:
-                    for f in up_files:
-                        ext = os.path.splitext(f.name)[1] or ".txt"
-                        with tempfile.NamedTemporaryFile(delete=False, suffix=ext) as tmp:
-                            tmp.write(f.getvalue()); temp_paths.append(tmp.name)
-                if audio_bytes:
-                    with tempfile.NamedTemporaryFile(delete=False, suffix=".wav") as tmp:
-                        tmp.write(audio_bytes); temp_paths.append(tmp.name)
-                
-                if not temp_paths:
-                    st.warning("Chưa có file!")
-                else:
-                    with st.spinner(f"Đang xử lý với {format_model_name(model_version)}..."):
-                        try:
-                            g_files = [upload_to_gemini(p) for p in temp_paths]
-                            st.session_state.gemini_files = g_files
-                            
-                            # Tắt bộ lọc an toàn
-                            safety_settings = [
-                                {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
-                                {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
-                                {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_NONE"},
-                                {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"},
-                            ]
-                            
-                            gen_config = genai.types.GenerationConfig(max_output_tokens=8192, temperature=0.2)
-
-                            if main_mode.startswith("📝"):
-                                prompt = f"""
-                                {STRICT_RULES}
-                                NHIỆM VỤ: Gỡ băng NGUYÊN VĂN 100%.
-                                YÊU CẦU:
-                                1. Bắt đầu mỗi câu bằng [Phút:Giây].
-                                2. Viết lại chính xác từng từ.
-                                3. Định danh: 'Người nói 1', 'Người nói 2'.
-                                4. Ngôn ngữ: Tiếng Việt.
-                                """
-                                # MẶC ĐỊNH BẬT AUTO CONTINUE
-                                st.session_state.is_auto_running = True
-                                st.session_state.loop_count = 1
-                            else:
-                                # TỔNG HỢP PROMPT FULL TÍNH NĂNG
-                                prompt = f"{STRICT_RULES}\nNHIỆM VỤ: Phân tích sâu {detail_level} cho các mục sau:\n"
-                                if opt_summary: prompt += "## TÓM TẮT & HÀNH ĐỘNG\n"
-                                if opt_process: prompt += "## QUY TRÌNH CHI TIẾT\n"
-                                if opt_prosody: prompt += "## PHÂN TÍCH CẢM XÚC\n"
-                                if opt_gossip: prompt += "## GÓC BÀ TÁM\n"
-                                if opt_podcast: prompt += "## KỊCH BẢN PODCAST\n"
-                                if opt_video: prompt += "## KỊCH BẢN VIDEO\n"
-                                if opt_mindmap: prompt += "## MÃ SƠ ĐỒ TƯ DUY (Mermaid)\n"
-                                if opt_report: prompt += "## BÁO CÁO CHUYÊN SÂU\n"
-                                if opt_briefing: prompt += "## BRIEFING DOC\n"
-                                if opt_timeline: prompt += "## TIMELINE SỰ KIỆN\n"
-                                if opt_faq: prompt += "## CÂU HỎI THƯỜNG GẶP (FAQ)\n"
-                                if opt_quiz: prompt += "## TRẮC NGHIỆM & THẺ NHỚ\n"
-                                if opt_slides: prompt += "## DÀN Ý SLIDE\n"
-                                if opt_table: prompt += "## BẢNG SỐ LIỆU\n"
-
-                            # LƯU TRẠNG THÁI ĐỂ RETRY
-                            st.session_state.last_prompt = prompt
-                            st.session_state.last_config = gen_config
-
-                            model = genai.GenerativeModel(model_version)
-                            response = model.generate_content(
-                                [prompt] + g_files, 
-                                generation_config=gen_config,
-                                safety_settings=safety_settings
-                            )
-                            
-                            st.session_state.analysis_result = get_safe_response(response)
-                            st.rerun()
-                            
-                        except Exception as e:
-                            err_msg = str(e)
-                            if "429" in err_msg or "Quota" in err_msg:
-                                st.session_state.quota_error = True
-                                st.rerun()
-                            elif "404" in err_msg or "Not Found" in err_msg:
-                                st.toast(f"⚠️ Model {format_model_name(model_version)} lỗi (404). Tự động chuyển sang 1.5 Flash...", icon="🔄")
-                                try:
-                                    fb_model = genai.GenerativeModel("models/gemini-1.5-flash")
-                                    response = fb_model.generate_content([prompt] + g_files, generation_config=gen_config, safety_settings=safety_settings)
-                                    st.session_state.analysis_result = get_safe_response(response)
-                                    st.rerun()
-                                except Exception as e2: st.error(f"Lỗi hệ thống: {e2}")
-                            else:
-                                st.error(f"Lỗi: {e}")
+        up_files = st.file_uploader("Upload file", accept_multiple_files=True)
+        audio_bytes = audio_recorder()
 
-        # HIỂN THỊ KẾT QUẢ
-        if st.session_state.analysis_result:
-            if st.session_state.is_auto_running:
-                st.warning(f"🔄 Đang tự động chạy tiếp (Vòng {st.session_state.loop_count})...")
-                if st.button("🛑 DỪNG"):
-                    st.session_state.is_auto_running = False
-                    st.success("Đã dừng."); st.rerun()
+        if st.button("🚀 BẮT ĐẦU", type="primary"):
+            sources = []
+            if up_files:
+                for f in up_files:
+                    data = f.getvalue(); sources.append((f.name, data, content_digest(data)))
+            if audio_bytes:
+                sources.append(("Ghi âm.wav", audio_bytes, content_digest(audio_bytes)))
 
+            if not model_chain:
+                st.warning("Chưa kết nối! Nhập API key trước.")
+            elif not sources:
+                st.warning("Chưa có file!")
+            else:
+                # Job chạy nền phía server: đóng tab hay chạy thêm job khác không làm dừng job này
+                params = {"mode": "transcribe" if main_mode.startswith("📝") else "analyze", "preprocess": use_prep, "segmented": seg_mode,
+                          "stream": use_stream}
+                if seg_mode:
+                    params.update(segment_minutes=seg_minutes, segment_workers=seg_workers)
+                if main_mode.startswith("📊"):
+                    params.update(detail_level=detail_level, fanout=opt_fanout, sections=[h for on, h in zip([
+                        opt_summary, opt_process, opt_prosody, opt_gossip, opt_podcast, opt_video, opt_mindmap,
+                        opt_report, opt_briefing, opt_timeline, opt_faq, opt_quiz, opt_slides, opt_table,
+                    ], ANALYSIS_SECTIONS) if on])
+                st.session_state.follow_job = manager.submit(get_owner(), sources, params, key_pool, model_chain, store)
+                st.rerun()
+
+        # DANH SÁCH JOB: chỉ đọc trạng thái, tự làm mới khi còn job đang chạy
+        active = any(j["status"] in ACTIVE_STATUSES for j in manager.list(get_owner()))
+        st.fragment(run_every=JOB_POLL_SECONDS if active else None)(render_jobs)(key_pool, model_chain, store, active)
+
+        # HIỂN THỊ KẾT QUẢ
+        transcript = st.session_state.transcript
+        if transcript:
             st.divider()
-            res = st.session_state.analysis_result
+            for note in st.session_state.prep_notes: st.caption(note)
+            cut_list = st.session_state.cut_list
             
-            # Xử lý Mindmap
-            if "```mermaid" in res:
-                try:
-                    m_code = res.split("```mermaid")[1].split("```")[0]
-                    st_mermaid(m_code, height=500)
-                except: pass
-            
-            # Hiển thị Text
-            sections = res.split("## ")
-            for s in sections:
-                if not s.strip(): continue
-                lines = s.split("\n")
-                with st.expander(f"📌 {lines[0].strip()}", expanded=True):
-                    st.markdown("\n".join(lines[1:]))
-
-            # Download
-            doc = create_docx(res)
-            doc_io = tempfile.NamedTemporaryFile(delete=False, suffix=".docx")
-            doc.save(doc_io.name)
-            with open(doc_io.name, "rb") as f:
-                st.download_button("📥 Tải Báo Cáo", f, "Bao_Cao.docx", type="primary")
-            os.remove(doc_io.name)
-
-            # AUTO-CONTINUE (Logic cũ + Retry Quota)
-            if st.session_state.is_auto_running and main_mode.startswith("📝"):
-                if "[DỪNG:" in res or "[CẢNH BÁO:" in res:
-                    st.session_state.is_auto_running = False
-                    st.error("⚠️ Dừng do bản quyền/an toàn.")
-                else:
-                    st.divider()
-                    placeholder = st.empty()
-                    for i in range(3, 0, -1):
-                        placeholder.info(f"⏳ Chạy tiếp trong {i}s...")
-                        time.sleep(1)
-                    placeholder.empty()
-                    
-                    with st.spinner("Đang nghe tiếp..."):
-                        try:
-                            cont_config = genai.types.GenerationConfig(max_output_tokens=8192, temperature=0.2)
-                            model = genai.GenerativeModel(model_version)
-                            last_part = res[-500:]
-                            c_prompt = f"""
-                            CONTEXT: Đang gỡ băng dở dang.
-                            MỎ NEO: "...{last_part}"
-                            NHIỆM VỤ: Tìm mỏ neo, viết tiếp NGUYÊN VĂN đoạn sau. KHÔNG viết lại mỏ neo.
-                            """
-                            
-                            safety_settings = [
-                                {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
-                                {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
-                                {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_NONE"},
-                                {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"},
-                            ]
-                            
-                            # Lưu trạng thái cho Retry
-                            st.session_state.last_prompt = c_prompt
-                            st.session_state.last_config = cont_config
-
-                            c_res = model.generate_content(
-                                [c_prompt] + st.session_state.gemini_files, 
-                                generation_config=cont_config,
-                                safety_settings=safety_settings
-                            )
-                            
-                            safe_c_text = get_safe_response(c_res)
-
-                            if len(safe_c_text) < 50 or "kết thúc" in safe_c_text.lower() or "[DỪNG:" in safe_c_text:
-                                st.session_state.is_auto_running = False
-                                st.success("✅ Đã xong!")
-                                if "[DỪNG:" in safe_c_text:
-                                    st.session_state.analysis_result += "\n\n" + safe_c_text
-                                    st.rerun()
-                            else:
-                                st.session_state.analysis_result += "\n\n" + safe_c_text
-                                st.session_state.loop_count += 1
-                                st.rerun()
-                        except Exception as e:
-                            err_msg = str(e)
-                            if "429" in err_msg or "Quota" in err_msg:
-                                st.session_state.quota_error = True
-                                st.session_state.is_auto_running = False # Dừng auto để xử lý lỗi
-                                st.rerun()
-                            elif "404" in err_msg:
-                                # 404 thì tự fallback luôn
-                                try:
-                                    fb_model = genai.GenerativeModel("models/gemini-1.5-flash")
-                                    c_res = fb_model.generate_content([c_prompt] + st.session_state.gemini_files, generation_config=cont_config, safety_settings=safety_settings)
-                                    st.session_state.analysis_result += "\n\n" + get_safe_response(c_res)
-                                    st.session_state.loop_count += 1
-                                    st.rerun()
-                                except: st.error("Lỗi hệ thống."); st.session_state.is_auto_running = False
-                            else:
-                                st.error(f"Lỗi: {e}")
-                                st.session_state.is_auto_running = False
+            with timed("render", segments=len(transcript.segments)):
+                # Xử lý Mindmap
+                m_code = transcript.mermaid()
+                if m_code:
+                    try: st_mermaid(m_code, height=500)
+                    except: pass
+
+                # Hiển thị Text: mỗi mục một expander, mục dài thì phân trang
+                for i, (title, segs) in enumerate(transcript.sections()):
+                    with st.expander(f"📌 {title or 'Nội dung'}", expanded=True):
+                        render_segments(segs, f"sec{i}", cut_list)
+
+            # Download: chỉ dựng file khi người dùng yêu cầu, cho đúng phiên bản nội dung hiện tại
+            c1, c2 = st.columns([1, 2])
+            export_fmt = c1.selectbox("Định dạng:", list(EXPORTERS), label_visibility="collapsed")
+            if c2.button("📦 Chuẩn bị file tải về"):
+                st.session_state.export_request = (export_fmt, transcript.version)
+            req = st.session_state.export_request
+            if req and req[1] == transcript.version:
+                fn, ext, mime = EXPORTERS[req[0]]
+                data = export_artifact(req[0], transcript.content_hash(req[0], cut_list), transcript, cut_list)
+                st.download_button(f"📥 Tải {req[0]}", data, f"Bao_Cao.{ext}", mime, type="primary")
+
+        # CHẨN ĐOÁN: thời gian từng giai đoạn, token từng request, retry/fallback
+        if show_diag:
+            with st.expander("🩺 Chẩn đoán", expanded=True):
+                job = manager.get(st.session_state.open_job or st.session_state.follow_job or "")
+                if job and job["metrics"]:
+                    st.markdown(f"**Job {job['title']}** (lượt chạy gần nhất)")
+                    render_metrics(job["metrics"])
+                st.markdown("**Giao diện** (hiển thị, xuất file, chat)")
+                render_metrics(st.session_state.ui_metrics.summary())
+                if METRICS_LOG_PATH: st.caption(f"Log chi tiết (JSON lines): {METRICS_LOG_PATH}")
 
     with tab_chat:
         st.header("💬 Chat")
-        if st.session_state.gemini_files:
+        if st.session_state.open_job and not model_chain: st.warning("Chưa kết nối! Nhập API key để chat.")
+        elif st.session_state.open_job:
             for m in st.session_state.chat_history:
-                with st.chat_message(m["role"]): st.markdown(m["content"])
+                with st.chat_message(m["role"]): st.markdown(remap_timestamps(m["content"], st.session_state.cut_list) if m["role"] == "assistant" else m["content"])
+            stats = st.session_state.cache_stats
+            if stats["hits"] or stats["misses"]:
+                st.caption(f"🧊 Context cache: {stats['hits']} lần dùng lại · {stats['misses']} lần gửi full · tiết kiệm {stats['saved_tokens']:,} token đầu vào")
+            use_rag = st.toggle("🔎 Trả lời từ bản gỡ băng (nhanh, ít token)", value=True,
+                                help="Chỉ gửi các đoạn [mm:ss] liên quan nhất; không tìm thấy đủ thì mới hỏi trên toàn bộ file.")
             if inp := st.chat_input("Hỏi AI..."):
+                history = list(st.session_state.chat_history)
                 st.session_state.chat_history.append({"role": "user", "content": inp})
                 with st.chat_message("user"): st.markdown(inp)
                 with st.chat_message("assistant"):
                     try:
-                        m = genai.GenerativeModel(model_version)
-                        r = m.generate_content(
-                            st.session_state.gemini_files + [f"Trả lời: {inp}"],
-                            safety_settings=[{"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"}]
-                        )
-                        st.markdown(r.text); st.session_state.chat_history.append({"role": "assistant", "content": r.text})
+                        answer_box = st.empty()
+                        usage, answer = {}, None
+                        if use_rag and st.session_state.transcript:
+                            index = st.session_state.chat_index.update(st.session_state.transcript)
+                            answer, hits = answer_from_transcript(
+                                key_pool, model_chain, index, history, inp, answer_box if use_stream else None, usage=usage,
+                                safety_settings=[{"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"}])
+                            if answer is not None:
+                                answer_box.markdown(remap_timestamps(answer, st.session_state.cut_list)); st.session_state.chat_history.append({"role": "assistant", "content": answer})
+                                st.caption(f"🔎 Từ {len(hits)} đoạn trích · {usage.get('prompt', 0):,} token đầu vào")
+                                with st.expander("Đoạn trích đã dùng"):
+                                    st.markdown(remap_timestamps("\n\n".join(seg["raw"] for seg in hits), st.session_state.cut_list))
+                            else: st.caption("🎧 Bản gỡ băng không đủ thông tin, hỏi trên toàn bộ file...")
+                        if answer is None:
+                            usage = {}
+                            if not st.session_state.gemini_files:
+                                with st.spinner("Đang nạp file của job..."):
+                                    st.session_state.gemini_files, st.session_state.file_digests = get_job_manager().files(
+                                        st.session_state.open_job, key_pool, lambda name, data, digest, trim: preprocess_audio_cached(digest, name, data, trim))
+                            st.session_state.context_cache = ensure_context_cache(
+                                key_pool, model_chain[0], st.session_state.gemini_files, st.session_state.file_digests, st.session_state.context_cache)
+                            answer, _, _ = generate_with_context(
+                                key_pool, model_chain, st.session_state.context_cache,
+                                build_chat_turns(history, inp), build_chat_turns(history, inp, st.session_state.gemini_files),
+                                answer_box if use_stream else None, stats=stats, usage=usage,
+                                safety_settings=[{"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"}]
+                            )
+                            answer_box.markdown(remap_timestamps(answer, st.session_state.cut_list)); st.session_state.chat_history.append({"role": "assistant", "content": answer})
+                            if usage.get("cached"):
+                                st.caption(f"🧊 {usage['cached']:,}/{usage['prompt']:,} token đầu vào lấy từ cache")
                     except: st.error("Lỗi chat.")
-        else: st.info("👈 Upload file trước.")
+        else: st.info("👈 Chạy hoặc mở một job trước.")
 
 if __name__ == "__main__":
-    main()
+    # Số liệu của các thao tác chạy trên giao diện (hiển thị, xuất file, chat) gom vào ui_metrics của session
+    with collect_metrics(st.session_state.ui_metrics):
+        main()
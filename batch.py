@@ -0,0 +1,178 @@
+# Chạy hàng loạt không cần giao diện, dùng chung lõi với app.py (pipeline.py).
+#   python batch.py thu_muc_ghi_am/ --out ket_qua/ --jobs 2
+#   python batch.py danh_sach.txt --mode analyze --sections "TÓM TẮT & HÀNH ĐỘNG" "BẢNG SỐ LIỆU"
+# Danh sách (manifest) là file text, mỗi dòng một đường dẫn, dòng bắt đầu bằng # bị bỏ qua.
+# Tiến độ ghi vào <out>/checkpoint.json: chạy lại đúng lệnh cũ sẽ bỏ qua file đã xong và gỡ tiếp các đoạn còn dở.
+import argparse
+import os
+import sys
+import time
+import json
+import hashlib
+import mimetypes
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pipeline import (
+    ANALYSIS_SECTIONS, DEFAULT_FALLBACK_MODELS, EXPORTERS, SEGMENT_MINUTES, SEGMENT_WORKERS,
+    Cancelled, RunMetrics, collect_metrics, content_digest, get_key_pool, get_optimized_models, get_response_store, run_export,
+    run_pipeline,
+)
+
+# --- 1. BIẾN TOÀN CỤC ---
+BATCH_JOBS = 2               # số file xử lý cùng lúc (mỗi file còn tự chia đoạn song song bên trong)
+MEDIA_PREFIXES = ("audio/", "video/", "text/", "application/pdf")
+
+# --- 2. HÀM HỖ TRỢ ---
+def list_inputs(src):
+    # Thư mục: mọi file media/văn bản bên trong (đệ quy). File: manifest, đường dẫn tương đối tính từ thư mục của manifest.
+    if os.path.isdir(src):
+        paths = [os.path.join(root, f) for root, _, files in os.walk(src) for f in files]
+        return sorted(p for p in paths if (mimetypes.guess_type(p)[0] or "").startswith(MEDIA_PREFIXES))
+    base = os.path.dirname(os.path.abspath(src))
+    with open(src, encoding="utf-8") as f:
+        lines = [l.strip() for l in f]
+    return [os.path.join(base, l) for l in lines if l and not l.startswith("#")]
+
+def env_keys():
+    raw = os.environ.get("SYSTEM_KEYS") or os.environ.get("GOOGLE_API_KEY") or ""
+    return [k.strip() for k in raw.replace('[','').replace(']','').replace('"','').replace("'",'').split(',') if k.strip()]
+
+def write_atomic(path, data):
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f: f.write(data)
+    os.replace(tmp, path)
+
+class Checkpoint:
+    # Trạng thái từng (file, bộ tham số) theo sha256 nội dung + hash tham số: status, params, state (đoạn/mục/lượt đã xong), outputs.
+    # Mỗi lần cập nhật ghi lại toàn bộ file (tmp + os.replace) nên bị ngắt giữa chừng cũng không hỏng.
+    def __init__(self, path):
+        self.path, self.lock = path, threading.Lock()
+        try:
+            with open(path, encoding="utf-8") as f: self.entries = json.load(f)
+        except: self.entries = {}
+
+    def get(self, key):
+        with self.lock: return dict(self.entries.get(key, {}))
+
+    def update(self, key, **fields):
+        # Chụp bản sao ngay trong luồng gọi: state có thể bị luồng worker sửa tiếp sau đó
+        fields = json.loads(json.dumps(fields, ensure_ascii=False))
+        with self.lock:
+            self.entries.setdefault(key, {}).update(fields)
+            write_atomic(self.path, json.dumps(self.entries, ensure_ascii=False, indent=1).encode("utf-8"))
+
+def process_file(path, args, pool, models, store, ckpt, cancel=None):
+    with open(path, "rb") as f: data = f.read()
+    digest = content_digest(data)
+    params = {"mode": args.mode, "sections": args.sections, "detail": args.detail, "preprocess": args.preprocess,
+              "segmented": not args.no_segment, "segment_minutes": args.segment_minutes}
+    # Mỗi bộ tham số (vd. transcribe rồi analyze trên cùng thư mục) có checkpoint và file kết quả riêng, không ghi đè nhau
+    tag = hashlib.sha256(json.dumps(params, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()[:6]
+    key = f"{digest}:{tag}"
+    entry = ckpt.get(key)
+    stem = os.path.join(args.out, f"{os.path.splitext(os.path.basename(path))[0]}_{digest[:8]}_{args.mode}_{tag}")
+    outputs = [f"{stem}.{EXPORTERS[fmt][1]}" for fmt in args.formats]
+    if entry.get("status") == "done" and all(os.path.exists(p) for p in outputs):
+        return "skip", outputs, None
+    state = entry.get("state") or {}
+    ckpt.update(key, path=path, status="running", params=params, state=state, error=None)
+    metrics = RunMetrics(f"batch:{os.path.basename(path)}")
+    try:
+        with collect_metrics(metrics):
+            transcript, cut_list = run_pipeline(
+                [(os.path.basename(path), data, digest)], pool, models, mode=args.mode, sections=args.sections,
+                detail_level=args.detail, store=store, preprocess=args.preprocess, segmented=not args.no_segment,
+                segment_minutes=args.segment_minutes, segment_workers=args.segment_workers, state=state,
+                on_progress=lambda state: ckpt.update(key, state=state), cancel=cancel)
+            for fmt, out in zip(args.formats, outputs):
+                write_atomic(out, run_export(fmt, transcript, cut_list))
+    except Cancelled:
+        ckpt.update(key, status="cancelled", state=state, metrics=metrics.summary())
+        return "cancelled", [], None
+    except Exception as e:
+        ckpt.update(key, status="error", error=str(e), state=state, metrics=metrics.summary())
+        raise
+    # Xong thì bỏ state cho checkpoint gọn; metrics bỏ danh sách từng request
+    summary = metrics.summary()
+    ckpt.update(key, status="done", outputs=outputs, state=None, seconds=summary["elapsed"],
+                metrics={k: v for k, v in summary.items() if k != "calls"})
+    return "done", outputs, summary
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description="Gỡ băng / phân tích hàng loạt bằng Gemini, có checkpoint để chạy tiếp.")
+    p.add_argument("input", help="Thư mục chứa file hoặc file danh sách (mỗi dòng một đường dẫn)")
+    p.add_argument("--out", default="ket_qua", help="Thư mục kết quả (chứa cả checkpoint.json)")
+    p.add_argument("--mode", choices=["transcribe", "analyze"], default="transcribe")
+    p.add_argument("--sections", nargs="+", choices=ANALYSIS_SECTIONS, default=[ANALYSIS_SECTIONS[0]], metavar="MỤC",
+                   help="Các mục phân tích (chế độ analyze)")
+    p.add_argument("--detail", choices=["Sơ lược", "Tiêu chuẩn", "Sâu"], default="Sâu")
+    p.add_argument("--model", help="Model chính (mặc định: model đầu tiên trong danh sách)")
+    p.add_argument("--fallback", nargs="*", default=DEFAULT_FALLBACK_MODELS, help="Model dự phòng theo thứ tự")
+    p.add_argument("--jobs", type=int, default=BATCH_JOBS, help="Số file xử lý cùng lúc")
+    p.add_argument("--segment-workers", type=int, default=SEGMENT_WORKERS)
+    p.add_argument("--segment-minutes", type=int, default=SEGMENT_MINUTES)
+    p.add_argument("--no-segment", action="store_true", help="Gỡ băng một lượt + chạy tiếp thay vì chia đoạn")
+    p.add_argument("--preprocess", action="store_true", help="Nén audio & cắt khoảng lặng trước khi upload")
+    p.add_argument("--no-memo", action="store_true", help="Không dùng bộ nhớ kết quả trên đĩa")
+    p.add_argument("--formats", nargs="+", choices=list(EXPORTERS), default=["DOCX", "JSON"])
+    p.add_argument("--keys", help="Danh sách API key, phân tách bằng dấu phẩy (mặc định: SYSTEM_KEYS / GOOGLE_API_KEY)")
+    return p.parse_args(argv)
+
+# --- 3. MAIN ---
+def main(argv=None):
+    args = parse_args(argv)
+    keys = [k.strip() for k in args.keys.split(",")] if args.keys else env_keys()
+    if not keys:
+        print("Chưa có API key (--keys hoặc biến môi trường SYSTEM_KEYS / GOOGLE_API_KEY).", file=sys.stderr); return 2
+    pool = get_key_pool()
+    pool.set_keys(keys)
+    # Upload và request sinh nội dung tự gắn key qua pool. genai giữ cấu hình ở mức tiến trình
+    # nên chạy song song bằng thread chứ không tách process.
+    model = args.model or get_optimized_models()[0]
+    models = [model] + [m for m in args.fallback if m != model]
+    store = None if args.no_memo else get_response_store()
+
+    paths = list_inputs(args.input)
+    if not paths:
+        print("Không có file nào để xử lý.", file=sys.stderr); return 2
+    os.makedirs(args.out, exist_ok=True)
+    ckpt = Checkpoint(os.path.join(args.out, "checkpoint.json"))
+
+    started, done, skipped, failed = time.monotonic(), 0, 0, []
+    totals = {"requests": 0, "prompt": 0, "output": 0, "retries": 0, "fallbacks": 0}
+    # Hàng đợi có giới hạn: tối đa --jobs file đang chạy, số request thật còn bị KeyPool giới hạn theo key
+    ex, cancel = ThreadPoolExecutor(max_workers=max(1, args.jobs)), threading.Event()
+    futs = {ex.submit(process_file, p, args, pool, models, store, ckpt, cancel): p for p in paths}
+    try:
+        for fut in as_completed(futs):
+            path = futs[fut]
+            try:
+                status, outputs, summary = fut.result()
+                if status == "skip":
+                    skipped += 1; print(f"⏭️ {path} -> {', '.join(outputs)}"); continue
+                done += 1
+                totals["requests"] += summary["requests"]
+                for k in ("prompt", "output"): totals[k] += summary["tokens"][k]
+                for k in ("retries", "fallbacks"): totals[k] += summary["counters"][k]
+                print(f"✅ {path} -> {', '.join(outputs)} ({summary['elapsed']:.1f}s, {summary['requests']} request, "
+                      f"{summary['tokens']['prompt']:,}/{summary['tokens']['output']:,} token vào/ra)")
+            except Exception as e:
+                failed.append(path); print(f"❌ {path}: {e}", file=sys.stderr)
+    except KeyboardInterrupt:
+        # File chưa bắt đầu thì hủy; file đang chạy dừng sau các request đang bay và ghi checkpoint, lần sau chạy tiếp
+        print("Đang dừng, chờ các file đang chạy ghi checkpoint...", file=sys.stderr)
+        cancel.set()
+        ex.shutdown(wait=True, cancel_futures=True)
+        print("Đã dừng. Chạy lại cùng lệnh để tiếp tục.", file=sys.stderr)
+        return 130
+    ex.shutdown()
+
+    hours = (time.monotonic() - started) / 3600
+    print(f"Xong {done} · bỏ qua {skipped} · lỗi {len(failed)} / {len(paths)} file"
+          f" · {done / hours if hours else 0:.1f} file/giờ · checkpoint: {ckpt.path}")
+    print(f"{totals['requests']} request · {totals['prompt']:,}/{totals['output']:,} token vào/ra"
+          f" · {totals['retries']} retry · {totals['fallbacks']} fallback")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,224 @@
+# Bản giả lập google.generativeai để đo pipeline offline (không mạng, không tốn quota).
+# install() phải chạy TRƯỚC khi import pipeline: nó thay các module google.generativeai[.client/.caching/.types[.file_types]]
+# trong sys.modules. Độ trễ, tỉ lệ lỗi 429/404 và độ dài output chỉnh qua FAKE (dict) giữa các kịch bản.
+import sys
+import os
+import re
+import time
+import types
+import random
+import threading
+import itertools
+
+# --- 1. CẤU HÌNH GIẢ LẬP ---
+DEFAULTS = {
+    "upload_latency": 0.05,        # giây cố định mỗi lần upload_file
+    "upload_bandwidth": 50e6,      # byte/giây
+    "processing_polls": 1,         # số lần get_file còn trả PROCESSING
+    "ttft": 0.15,                  # giây tới token đầu tiên
+    "tokens_per_second": 4000,     # tốc độ sinh
+    "output_tokens": 600,          # số token (~ số từ) mỗi câu trả lời
+    "media_tokens": 20000,         # token đầu vào tính cho mỗi file media
+    "quota_rate": 0.0,             # xác suất một request bị 429
+    "quota_retry": 0.2,            # giây gợi ý trong lỗi 429 (thành thời gian nghỉ của key)
+    "not_found_models": (),        # model trả 404
+    "continue_rounds": 3,          # số vòng chạy tiếp trước khi trả "kết thúc"
+    "cache_supported": True,       # CachedContent.create có thành công không
+    "seed": 0,
+}
+FAKE = dict(DEFAULTS)
+STATS = {"uploads": 0, "polls": 0, "requests": 0, "quota_errors": 0, "not_found": 0, "cache_creates": 0}
+_lock = threading.Lock()
+_rng = random.Random(0)
+_ids = itertools.count(1)
+_files, _caches, _rounds = {}, {}, {}
+_config = {"api_key": None}
+
+def reset(**overrides):
+    FAKE.clear(); FAKE.update(DEFAULTS, **overrides)
+    _rng.seed(FAKE["seed"])
+    for k in STATS: STATS[k] = 0
+    _files.clear(); _caches.clear(); _rounds.clear()
+
+def _bump(name):
+    with _lock: STATS[name] += 1
+
+# --- 2. ĐỐI TƯỢNG GIẢ ---
+class _State:
+    def __init__(self, name): self.name = name
+
+class File:
+    def __init__(self, display_name, size):
+        self.name = f"files/fake-{next(_ids)}"
+        self.display_name, self.size = display_name, size
+        self.polls_left = FAKE["processing_polls"]
+        self.state = _State("PROCESSING" if self.polls_left else "ACTIVE")
+        self.expiration_time = None
+
+class _Part:
+    def __init__(self, text): self.text = text
+
+class _Candidate:
+    def __init__(self, finish_reason): self.finish_reason = finish_reason
+
+class _Usage:
+    def __init__(self, prompt, output, cached):
+        self.prompt_token_count, self.candidates_token_count = prompt, output
+        self.cached_content_token_count, self.total_token_count = cached, prompt + output
+
+class Response:
+    def __init__(self, text, usage, finish_reason=1):
+        self.text, self.usage_metadata = text, usage
+        self.parts, self.candidates = [_Part(text)], [_Candidate(finish_reason)]
+
+class StreamResponse:
+    # Lặp ra từng chunk; usage_metadata có sẵn như bản thật sau khi stream xong
+    def __init__(self, chunks, usage, delay):
+        self.chunks, self.usage_metadata, self.delay = chunks, usage, delay
+
+    def __iter__(self):
+        for i, text in enumerate(self.chunks):
+            if i: time.sleep(self.delay)
+            yield Response(text, self.usage_metadata, 1 if i == len(self.chunks) - 1 else 0)
+
+def _prompt_text(contents):
+    parts = []
+    for c in contents:
+        if isinstance(c, str): parts.append(c)
+        elif isinstance(c, dict): parts.extend(p for p in c.get("parts", []) if isinstance(p, str))
+    return "\n".join(parts)
+
+def _media_count(contents):
+    n = 0
+    for c in contents:
+        if isinstance(c, File): n += 1
+        elif isinstance(c, dict): n += sum(isinstance(p, File) for p in c.get("parts", []))
+    return n
+
+def _fake_transcript(prompt, words):
+    # Câu có mốc giờ nằm trong khoảng được hỏi để ghép đoạn/xuất file chạy như thật
+    m = re.search(r"từ \[(\d+):(\d\d)\] đến \[(\d+):(\d\d)\]", prompt)
+    start, end = (int(m.group(1)) * 60 + int(m.group(2)), int(m.group(3)) * 60 + int(m.group(4))) if m else (0, 600)
+    lines, per_line = [], 12
+    n = max(1, words // per_line)
+    for i in range(n):
+        t = start + (end - start) * i // n
+        lines.append(f"[{t // 60:02d}:{t % 60:02d}] Người nói {i % 2 + 1}: " + " ".join(f"từ{(i * per_line + j) % 97}" for j in range(per_line)))
+    return "\n".join(lines)
+
+def _answer(model_name, prompt):
+    if "MỎ NEO" in prompt:
+        with _lock:
+            _rounds[model_name] = _rounds.get(model_name, 0) + 1
+            if _rounds[model_name] > FAKE["continue_rounds"]: return "Đã kết thúc."
+    if "## " in prompt and "Phân tích" in prompt:
+        heading = prompt.split("## ", 1)[1].split("\n")[0]
+        return f"## {heading}\n" + "\n".join(f"- Ý {i}: " + "nội dung " * 10 for i in range(max(1, FAKE["output_tokens"] // 12)))
+    return _fake_transcript(prompt, FAKE["output_tokens"])
+
+class GenerativeModel:
+    def __init__(self, model_name, cached=None, **kwargs):
+        self.model_name, self.cached, self._client = model_name, cached, None
+
+    @classmethod
+    def from_cached_content(cls, cache_name):
+        cache = _caches[cache_name]
+        return cls(cache.model, cached=cache)
+
+    def generate_content(self, contents, stream=False, **kwargs):
+        _bump("requests")
+        contents = contents if isinstance(contents, list) else [contents]
+        if self.model_name in FAKE["not_found_models"]:
+            _bump("not_found"); raise Exception(f"404 Not Found: {self.model_name} is not found")
+        with _lock: quota = _rng.random() < FAKE["quota_rate"]
+        if quota:
+            _bump("quota_errors")
+            raise Exception(f"429 Resource has been exhausted (e.g. check quota). Please retry in {FAKE['quota_retry']}s")
+        prompt = _prompt_text(contents)
+        text = _answer(self.model_name, prompt)
+        output = len(text.split())
+        cached = self.cached.tokens if self.cached else 0
+        usage = _Usage(len(prompt) // 4 + _media_count(contents) * FAKE["media_tokens"] + cached, output, cached)
+        time.sleep(FAKE["ttft"])
+        gen_time = output / FAKE["tokens_per_second"]
+        if not stream:
+            time.sleep(gen_time)
+            return Response(text, usage)
+        lines = text.split("\n")
+        return StreamResponse(["\n".join(lines[i:i + 5]) + "\n" for i in range(0, len(lines), 5)], usage,
+                              gen_time / max(1, len(lines) // 5))
+
+class CachedContent:
+    def __init__(self, model, contents):
+        self.name = f"cachedContents/fake-{next(_ids)}"
+        self.model, self.tokens = model, _media_count(contents) * FAKE["media_tokens"]
+
+    @classmethod
+    def create(cls, model, contents, system_instruction=None, ttl=None):
+        _bump("cache_creates")
+        if not FAKE["cache_supported"]: raise Exception("400 Cached content is not supported for this model")
+        cache = cls(model, contents)
+        _caches[cache.name] = cache
+        return cache
+
+    @classmethod
+    def get(cls, name):
+        return _caches[name]
+
+    def update(self, ttl=None):
+        return self
+
+def configure(api_key=None, **kwargs):
+    _config["api_key"] = api_key
+
+def upload_file(path, mime_type=None, display_name=None):
+    _bump("uploads")
+    size = os.path.getsize(path)
+    time.sleep(FAKE["upload_latency"] + size / FAKE["upload_bandwidth"])
+    f = File(display_name or os.path.basename(path), size)
+    _files[f.name] = f
+    return f
+
+def get_file(name):
+    _bump("polls")
+    f = _files[name]
+    if f.polls_left:
+        f.polls_left -= 1
+        if not f.polls_left: f.state = _State("ACTIVE")
+    return f
+
+def list_models():
+    return []
+
+class FileClient:
+    # Như client.get_default_file_client(): gắn key lúc tạo (pipeline upload qua KeyPool.bind_files)
+    def __init__(self, api_key): self.api_key = api_key
+
+    def create_file(self, path, mime_type=None, display_name=None, **kwargs):
+        return upload_file(path, mime_type, display_name)
+
+    def get_file(self, name):
+        return get_file(name)
+
+# --- 3. CÀI VÀO sys.modules ---
+def install(**overrides):
+    reset(**overrides)
+    genai = types.ModuleType("google.generativeai")
+    client = types.ModuleType("google.generativeai.client")
+    caching = types.ModuleType("google.generativeai.caching")
+    gtypes = types.ModuleType("google.generativeai.types")
+    file_types = types.ModuleType("google.generativeai.types.file_types")
+    client.get_default_generative_client = lambda: ("fake-client", _config["api_key"])
+    client.get_default_file_client = lambda: FileClient(_config["api_key"])
+    file_types.File = lambda f: f
+    caching.CachedContent = CachedContent
+    gtypes.GenerationConfig = lambda **kw: dict(kw)
+    genai.configure, genai.upload_file, genai.get_file, genai.list_models = configure, upload_file, get_file, list_models
+    genai.GenerativeModel, genai.client, genai.caching, genai.types = GenerativeModel, client, caching, gtypes
+    gtypes.file_types = file_types
+    sys.modules.update({"google.generativeai": genai, "google.generativeai.client": client,
+                        "google.generativeai.caching": caching, "google.generativeai.types": gtypes,
+                        "google.generativeai.types.file_types": file_types})
+    google = sys.modules.get("google") or sys.modules.setdefault("google", types.ModuleType("google"))
+    google.generativeai = genai
+    return genai
@@ -0,0 +1,178 @@
+# Benchmark pipeline offline với backend Gemini giả lập (bench/fake_genai.py): đo thông lượng / độ trễ
+# của upload, gỡ băng chia đoạn, chạy tiếp, phân tích từng mục, xuất file... khi không có mạng.
+#   python bench/run_bench.py                          # chạy mọi kịch bản
+#   python bench/run_bench.py -k segments --scale 2    # chỉ kịch bản có chữ "segments", mọi độ trễ x2
+#   python bench/run_bench.py --save mốc.json          # lưu kết quả làm mốc
+#   python bench/run_bench.py --compare mốc.json --tolerance 0.25   # chậm hơn mốc quá 25% thì exit 1
+import io
+import os
+import sys
+import wave
+import json
+import time
+import argparse
+import tempfile
+import statistics
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import fake_genai
+fake_genai.install()   # phải chạy trước khi import pipeline
+import pipeline
+from pipeline import (
+    ANALYSIS_SECTIONS, KeyPool, ResponseStore, RunMetrics, TranscriptIndex, TranscriptStore, answer_from_transcript,
+    collect_metrics, content_digest, run_export, run_pipeline, upload_many,
+)
+
+# --- 1. KỊCH BẢN ---
+MAIN, FALLBACK = "models/fake-main", "models/fake-fallback"
+
+def media(size=200_000, name="bench.wav"):
+    data = os.urandom(size)
+    return (name, data, content_digest(data))
+
+def wav_media(seconds=3600, name="bench.wav"):
+    # WAV hợp lệ 1 mẫu/giây: probe_duration đo được thời lượng thật mà file vẫn nhỏ
+    buf = io.BytesIO()
+    with wave.open(buf, "wb") as w:
+        w.setnchannels(1); w.setsampwidth(2); w.setframerate(1); w.writeframes(os.urandom(seconds * 2))
+    data = buf.getvalue()
+    return (name, data, content_digest(data))
+
+def fake_cut_segments(name, data, windows):
+    # Thay ffmpeg: mỗi đoạn là phần byte tương ứng của file (cố định giữa các lần chạy để bộ nhớ kết quả còn khớp)
+    chunks = [data[44 + int(w["from"]) * 2:44 + int(w["to"]) * 2] for w in windows]
+    return [(f"{os.path.splitext(name)[0]}_{int(w['from'])}.mp3", c, content_digest(c)) for w, c in zip(windows, chunks)]
+
+def long_transcript(lines=3000):
+    return "\n".join(f"[{i // 6:02d}:{i * 10 % 60:02d}] Người nói {i % 3 + 1}: câu thứ {i} " + "lorem ipsum " * 8 for i in range(lines))
+
+def sc_upload(env):
+    upload_many([media(1_000_000, f"f{i}.wav") for i in range(16)], KeyPool(["k1"]))
+
+def sc_segments(env):
+    run_pipeline([wav_media()], KeyPool(["k1", "k2"]), [MAIN])
+
+def sc_segments_429(env):
+    run_pipeline([wav_media()], KeyPool(["k1", "k2", "k3"]), [MAIN, FALLBACK])
+
+def sc_unknown_duration(env):
+    # Không đo được thời lượng: gỡ một lượt + chạy tiếp thay vì đoán rồi gửi cả file cho từng đoạn
+    run_pipeline([media(name="bench.mp3")], KeyPool(["k1", "k2"]), [MAIN])
+
+def sc_fallback_404(env):
+    run_pipeline([wav_media(1800)], KeyPool(["k1", "k2"]), ["models/fake-missing", MAIN])
+
+def sc_continuous(env):
+    run_pipeline([media()], KeyPool(["k1"]), [MAIN], segmented=False)
+
+def sc_sections(env):
+    run_pipeline([media(name="bench.pdf")], KeyPool(["k1", "k2"]), [MAIN], mode="analyze", sections=ANALYSIS_SECTIONS)
+
+def sc_memo(env):
+    # Lần 2 cùng nội dung phải trả về từ bộ nhớ, gần như không tốn request
+    store, src = ResponseStore(path=os.path.join(env["tmp"], "memo.sqlite")), [wav_media()]
+    for _ in range(2): run_pipeline(src, KeyPool(["k1"]), [MAIN], store=store)
+
+def sc_export(env):
+    transcript = TranscriptStore(long_transcript())
+    for fmt in pipeline.EXPORTERS: run_export(fmt, transcript)
+
+def sc_store_append(env):
+    # Mỗi vòng chạy tiếp nối thêm rồi giao diện đọc lại text / sections như một lần rerun
+    store, text = TranscriptStore(), long_transcript(4000).split("\n")
+    for i in range(0, len(text), 100):
+        store.append("\n".join(text[i:i + 100])); store.text; store.sections(); store.tail(500)
+
+def sc_chat_retrieval(env):
+    # Chỉ mục dựng tăng dần theo từng vòng, rồi 20 câu hỏi chỉ gửi đoạn trích: token vào không phụ thuộc độ dài bản ghi
+    store, index, text = TranscriptStore(), TranscriptIndex(), long_transcript(4000).split("\n")
+    for i in range(0, len(text), 100):
+        store.append("\n".join(text[i:i + 100])); index.update(store)
+    for i in range(20): answer_from_transcript(KeyPool(["k1"]), [MAIN], index, [], f"câu thứ {i * 150} nói gì")
+
+# (tên, cấu hình backend giả, hàm)
+SCENARIOS = [
+    ("upload_16_files", {"processing_polls": 1}, sc_upload),
+    ("segments_60min", {}, sc_segments),
+    ("segments_60min_429", {"quota_rate": 0.3}, sc_segments_429),
+    ("unknown_duration", {"continue_rounds": 2}, sc_unknown_duration),
+    ("fallback_404", {"not_found_models": ("models/fake-missing",)}, sc_fallback_404),
+    ("continuous_cached", {"continue_rounds": 4}, sc_continuous),
+    ("continuous_no_cache", {"continue_rounds": 4, "cache_supported": False}, sc_continuous),
+    ("sections_14", {"output_tokens": 300}, sc_sections),
+    ("memo_rerun", {}, sc_memo),
+    ("export_3000_lines", {}, sc_export),
+    ("store_append_40_rounds", {}, sc_store_append),
+    ("chat_retrieval_20q", {"output_tokens": 100}, sc_chat_retrieval),
+]
+SCALED_UP = ("upload_latency", "ttft", "quota_retry")   # nhân với --scale
+SCALED_DOWN = ("upload_bandwidth", "tokens_per_second")  # chia cho --scale
+
+# --- 2. ĐO ---
+def run_scenario(name, overrides, fn, scale, tmp):
+    cfg = dict(fake_genai.DEFAULTS, **overrides)
+    for k in SCALED_UP: cfg[k] *= scale
+    for k in SCALED_DOWN: cfg[k] /= scale
+    fake_genai.reset(**cfg)
+    pipeline.get_upload_cache.cache_clear()   # mỗi kịch bản bắt đầu với cache upload trống
+    metrics, error = RunMetrics(name), None
+    started = time.perf_counter()
+    with collect_metrics(metrics):
+        try: fn({"tmp": tmp})
+        except Exception as e: error = str(e)[:120]
+    wall = time.perf_counter() - started
+    summary = metrics.summary()
+    latencies = sorted(c["seconds"] for c in summary["calls"])
+    return {"wall": round(wall, 3), "requests": summary["requests"],
+            "p50": round(statistics.median(latencies), 3) if latencies else 0.0,
+            "p95": round(latencies[int(0.95 * (len(latencies) - 1))], 3) if latencies else 0.0,
+            "rps": round(summary["requests"] / wall, 2) if wall else 0.0,
+            "tokens_in": summary["tokens"]["prompt"], "tokens_out": summary["tokens"]["output"],
+            "cached_tokens": summary["tokens"]["cached"], "counters": summary["counters"],
+            "stages": {k: v["seconds"] for k, v in summary["stages"].items()},
+            "backend": dict(fake_genai.STATS), "error": error}
+
+def print_table(results, baseline=None):
+    print(f"{'Kịch bản':<26}{'Wall(s)':>9}{'Req':>6}{'p50(s)':>8}{'p95(s)':>8}{'Req/s':>7}{'Tok vào':>10}{'Cache':>9}{'Tok ra':>8}{'Retry':>6}{'Fallb':>6}  So với mốc")
+    for name, r in results.items():
+        c, base = r["counters"], (baseline or {}).get(name)
+        delta = f"{(r['wall'] / base['wall'] - 1) * 100:+.0f}%" if base and base["wall"] else ""
+        print(f"{name:<26}{r['wall']:>9.3f}{r['requests']:>6}{r['p50']:>8.3f}{r['p95']:>8.3f}{r['rps']:>7.1f}"
+              f"{r['tokens_in']:>10,}{r['cached_tokens']:>9,}{r['tokens_out']:>8,}{c['retries']:>6}{c['fallbacks']:>6}  {delta}"
+              + (f"  ❌ {r['error']}" if r["error"] else ""))
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description="Benchmark pipeline với backend Gemini giả lập.")
+    p.add_argument("-k", dest="filter", help="Chỉ chạy kịch bản có tên chứa chuỗi này")
+    p.add_argument("--scale", type=float, default=1.0, help="Hệ số độ trễ của backend giả")
+    p.add_argument("--repeat", type=int, default=1, help="Chạy mỗi kịch bản N lần, lấy lần nhanh nhất")
+    p.add_argument("--save", help="Ghi kết quả ra file JSON (làm mốc)")
+    p.add_argument("--compare", help="File JSON mốc để so sánh")
+    p.add_argument("--tolerance", type=float, default=0.25, help="Chậm hơn mốc quá tỉ lệ này thì coi là tụt hiệu năng")
+    p.add_argument("--log", action="store_true", help="Ghi log JSON lines như khi chạy thật")
+    args = p.parse_args(argv)
+    if not args.log: pipeline.METRICS_LOG_PATH = None
+    pipeline.cut_segments = fake_cut_segments   # máy đo không cần ffmpeg
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f: baseline = json.load(f)["results"]
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, overrides, fn in SCENARIOS:
+            if args.filter and args.filter not in name: continue
+            runs = [run_scenario(name, overrides, fn, args.scale, tmp) for _ in range(max(1, args.repeat))]
+            results[name] = min(runs, key=lambda r: r["wall"])
+    print_table(results, baseline)
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump({"scale": args.scale, "created": time.strftime("%Y-%m-%d %H:%M:%S"), "results": results}, f, ensure_ascii=False, indent=1)
+    failed = [n for n, r in results.items() if r["error"]]
+    regressed = [n for n, r in results.items() if baseline and n in baseline and baseline[n]["wall"]
+                 and r["wall"] > baseline[n]["wall"] * (1 + args.tolerance)]
+    if regressed: print(f"⚠️ Chậm hơn mốc quá {args.tolerance:.0%}: {', '.join(regressed)}", file=sys.stderr)
+    if failed: print(f"❌ Lỗi: {', '.join(failed)}", file=sys.stderr)
+    return 1 if failed or regressed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
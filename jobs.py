@@ -0,0 +1,186 @@
+# Chạy job gỡ băng / phân tích ở nền phía server, tách khỏi vòng rerun của Streamlit.
+# Mỗi job có ID, tiến độ lưu ra đĩa (.cache/jobs) và cờ hủy riêng; giao diện chỉ đọc trạng thái để vẽ,
+# nên đóng tab hay bấm dừng không làm mất phần đã xong, và một người dùng chạy được nhiều job cùng lúc.
+import os
+import json
+import time
+import uuid
+import shutil
+import threading
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from pipeline import (
+    Cancelled, RunMetrics, collect_metrics, get_upload_cache, is_quota_error, partial_text, preprocess_sources,
+    run_pipeline, upload_many,
+)
+
+# --- 1. BIẾN TOÀN CỤC ---
+JOBS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "jobs")
+JOB_WORKERS = 4                    # số job chạy cùng lúc trên cả server, job thừa xếp hàng
+JOB_KEEP_SECONDS = 7 * 24 * 3600   # job không đụng tới quá 7 ngày thì dọn (khi khởi động, tạo job và liệt kê job)
+ACTIVE_STATUSES = ("queued", "running")
+
+# --- 2. QUẢN LÝ JOB ---
+class JobManager:
+    # Bản ghi job: id, owner, title, sources [[tên, sha256]], params (tham số run_pipeline), status
+    # (queued/running/done/error/cancelled/interrupted), state (checkpoint của run_pipeline, gồm cả cut list), result, error,
+    # metrics (RunMetrics.summary() của lượt chạy gần nhất). get()/list() thêm `live` (chỉ trong bộ nhớ, khi đang chạy):
+    # trạng thái upload từng file và phần đang sinh của từng đoạn/mục/lượt.
+    # File gốc lưu ở <root>/<id>/<i> để chạy tiếp được cả sau khi server khởi động lại.
+    def __init__(self, root=JOBS_DIR, max_workers=JOB_WORKERS):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        self.lock = threading.Lock()
+        self.jobs, self.cancels, self.live = {}, {}, {}
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="job")
+        self._load()
+
+    def _load(self):
+        for f in os.listdir(self.root):
+            if not f.endswith(".json"): continue
+            try:
+                with open(os.path.join(self.root, f), encoding="utf-8") as fh: job = json.load(fh)
+            except: continue
+            # Server tắt giữa chừng: job dở dang chờ người dùng bấm chạy tiếp
+            if job["status"] in ACTIVE_STATUSES: job["status"] = "interrupted"
+            self.jobs[job["id"]] = job
+        self._prune()
+
+    def _prune(self):
+        # Dọn job (cả file gốc) không đụng tới quá JOB_KEEP_SECONDS; chạy cả khi khởi động, khi tạo job mới và khi
+        # liệt kê job, để server chạy lâu không đầy đĩa. Job đang chạy không bao giờ bị dọn.
+        now = time.time()
+        with self.lock:
+            old = [j["id"] for j in self.jobs.values() if j["status"] not in ACTIVE_STATUSES and now - j["updated"] > JOB_KEEP_SECONDS]
+            for job_id in old: self.jobs.pop(job_id)
+        for job_id in old: self._remove_files(job_id)
+
+    def _dir(self, job_id):
+        return os.path.join(self.root, job_id)
+
+    def _save(self, job):
+        # Gọi khi đang giữ lock. Ghi tmp + os.replace nên tắt ngang cũng không hỏng file.
+        job["updated"] = time.time(); job["version"] += 1
+        path = os.path.join(self.root, f"{job['id']}.json")
+        with open(path + ".tmp", "w", encoding="utf-8") as f: json.dump(job, f, ensure_ascii=False)
+        os.replace(path + ".tmp", path)
+
+    def _update(self, job_id, **fields):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None: return   # job đã bị xóa trong lúc chạy
+            job.update(fields); self._save(job)
+
+    def _remove_files(self, job_id):
+        shutil.rmtree(self._dir(job_id), ignore_errors=True)
+        try: os.remove(os.path.join(self.root, f"{job_id}.json"))
+        except OSError: pass
+
+    def submit(self, owner, sources, params, pool, models, store=None):
+        # sources: [(tên, bytes, sha256)]; params: tham số từ khóa của run_pipeline (mode, sections, ...)
+        self._prune()
+        job_id = uuid.uuid4().hex[:12]
+        os.makedirs(self._dir(job_id))
+        for i, (_, data, _) in enumerate(sources):
+            with open(os.path.join(self._dir(job_id), str(i)), "wb") as f: f.write(data)
+        now = time.time()
+        job = {"id": job_id, "owner": owner, "title": ", ".join(n for n, _, _ in sources),
+               "sources": [[n, d] for n, _, d in sources], "params": params, "status": "queued",
+               "state": {}, "result": None, "error": None, "quota": False, "metrics": None,
+               "created": now, "updated": now, "version": 0}
+        with self.lock:
+            self.jobs[job_id] = job; self._save(job)
+        self._start(job_id, pool, models, store)
+        return job_id
+
+    def resume(self, job_id, pool, models, store=None):
+        # Chạy tiếp job lỗi/đã hủy/bị ngắt: run_pipeline bỏ qua các đoạn/mục/lượt đã có trong state
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None or job["status"] in ACTIVE_STATUSES: return
+            job.update(status="queued", error=None, quota=False); self._save(job)
+        self._start(job_id, pool, models, store)
+
+    def cancel(self, job_id):
+        with self.lock: event = self.cancels.get(job_id)
+        if event: event.set()
+
+    def delete(self, job_id):
+        self.cancel(job_id)
+        with self.lock:
+            self.jobs.pop(job_id, None); self.cancels.pop(job_id, None)
+        self._remove_files(job_id)
+
+    def _start(self, job_id, pool, models, store):
+        cancel = threading.Event()
+        with self.lock: self.cancels[job_id] = cancel
+        self.executor.submit(self._run, job_id, pool, models, store, cancel)
+
+    def _run(self, job_id, pool, models, store, cancel):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None: return
+            params, state = job["params"], json.loads(json.dumps(job["state"]))   # bản riêng của worker
+        # Snapshot qua JSON: worker còn sửa `state` tiếp trong khi giao diện đọc bản đã lưu
+        snapshot = lambda state: json.loads(json.dumps(state))
+        metrics, live = RunMetrics(f"job:{job_id}"), {}
+        with self.lock: self.live[job_id] = live
+        try:
+            if cancel.is_set(): raise Cancelled()
+            self._update(job_id, status="running")
+            with collect_metrics(metrics):
+                transcript, _ = run_pipeline(self.sources(job_id), pool, models, store=store, state=state,
+                                             on_progress=lambda state: self._update(job_id, state=snapshot(state), metrics=metrics.summary()),
+                                             cancel=cancel, live=live, **params)
+            self._update(job_id, status="done", state=snapshot(state), result=transcript.text, metrics=metrics.summary())
+        except Cancelled:
+            self._update(job_id, status="cancelled", state=snapshot(state), metrics=metrics.summary())
+        except Exception as e:
+            self._update(job_id, status="error", state=snapshot(state), error=str(e), quota=is_quota_error(e), metrics=metrics.summary())
+        finally:
+            with self.lock:
+                if self.cancels.get(job_id) is cancel: self.cancels.pop(job_id)
+                if self.live.get(job_id) is live: self.live.pop(job_id)
+
+    def sources(self, job_id):
+        with self.lock: names = list(self.jobs[job_id]["sources"])
+        out = []
+        for i, (name, digest) in enumerate(names):
+            with open(os.path.join(self._dir(job_id), str(i)), "rb") as f: out.append((name, f.read(), digest))
+        return out
+
+    def files(self, job_id, pool, prep=None):
+        # File Gemini của job (cho chat): bản đã upload còn hạn thì lấy từ cache, hết hạn thì tiền xử lý + upload lại
+        with self.lock: preprocess = self.jobs[job_id]["params"].get("preprocess")
+        sources = self.sources(job_id)
+        if preprocess: sources, _, _ = preprocess_sources(sources, prep)
+        return upload_many(sources, pool, cache=get_upload_cache()), [d for _, _, d in sources]
+
+    def _view(self, job):
+        # Gọi khi đang giữ lock. Bản sao nông: state/result luôn được thay cả object khi cập nhật nên đọc ngoài lock vẫn an toàn
+        live = self.live.get(job["id"]) or {}
+        return dict(job, live={"uploads": dict(live.get("uploads") or {}), "streams": dict(live.get("streams") or {})})
+
+    def get(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return self._view(job) if job else None
+
+    def list(self, owner):
+        self._prune()
+        with self.lock:
+            return sorted((self._view(j) for j in self.jobs.values() if j["owner"] == owner), key=lambda j: j["created"], reverse=True)
+
+def job_progress(job):
+    # (đã xong, tổng hoặc None nếu không biết trước, ví dụ gỡ băng chạy tiếp theo vòng)
+    state = job["state"]
+    done = len(state.get("segments") or state.get("sections") or state.get("rounds") or [])
+    return done, state.get("total")
+
+def job_text(job):
+    return job["result"] if job["status"] == "done" else partial_text(job["state"])
+
+@lru_cache(maxsize=None)
+def get_job_manager():
+    # Một manager cho cả process: job sống tiếp khi session/tab đóng
+    return JobManager()
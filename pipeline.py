@@ -0,0 +1,1388 @@
+# Lõi xử lý dùng chung cho giao diện Streamlit (app.py) và chạy hàng loạt (batch.py).
+# Không import streamlit: mọi thứ ở đây chạy được headless.
+import google.generativeai as genai
+from google.generativeai import client as genai_client
+from google.generativeai import caching as genai_caching
+from google.generativeai.types import file_types as genai_file_types
+from docx import Document
+import tempfile
+import os
+import time
+import mimetypes
+import re
+import random
+import hashlib
+import threading
+import io
+import wave
+import shutil
+import subprocess
+import datetime
+import json
+import sqlite3
+import contextvars
+import math
+import heapq
+import unicodedata
+from contextlib import closing, contextmanager
+from bisect import bisect_right
+from functools import lru_cache
+import numpy as np
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, wait, as_completed, FIRST_COMPLETED
+
+# --- 1. BIẾN TOÀN CỤC ---
+STRICT_RULES = "CHỈ DÙNG FILE GỐC. CẤM BỊA TÊN DIỄN GIẢ. CẤM BỊA NỘI DUNG. TRÍCH DẪN GIỜ [mm:ss]."
+# Tắt bộ lọc an toàn
+SAFETY_SETTINGS = [
+    {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
+    {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
+    {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_NONE"},
+    {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"},
+]
+# Upload song song
+UPLOAD_WORKERS = 4       # số file tải lên cùng lúc
+UPLOAD_TIMEOUT = 600     # giây tối đa cho mỗi file (tải lên + PROCESSING)
+POLL_MAX_DELAY = 16      # trần backoff khi chờ PROCESSING (giây)
+# Cache file đã upload (dùng chung mọi session)
+UPLOAD_CACHE_TTL = 46 * 3600   # Gemini giữ file 48h, chừa biên an toàn
+UPLOAD_CACHE_MAX = 200         # số file tối đa trong cache (LRU)
+# Gỡ băng phân đoạn song song
+SEGMENT_MINUTES = 10     # độ dài mỗi đoạn
+SEGMENT_OVERLAP = 15     # giây chồng lấn 2 bên mỗi đoạn để không mất câu ở ranh giới
+SEGMENT_WORKERS = 4      # số đoạn gỡ cùng lúc
+# Phân tích từng mục song song
+SECTION_WORKERS = 4      # số mục phân tích chạy cùng lúc
+LIVE_TAIL_CHARS = 1500   # số ký tự cuối của phần đang sinh giữ lại cho giao diện theo dõi job
+# Tiền xử lý audio (nén mono + cắt khoảng lặng)
+PREP_SAMPLE_RATE = 16000     # Hz, đủ cho giọng nói
+PREP_FRAME_MS = 30           # độ dài khung tính năng lượng
+PREP_MARGIN_DB = 12          # khung to hơn nền ồn (percentile 10) bao nhiêu dB thì coi là có tiếng
+PREP_FLOOR_DB = -55          # dưới mức này luôn là im lặng
+PREP_MIN_SILENCE = 1.5       # giây; khoảng lặng ngắn hơn thì giữ nguyên
+PREP_PAD = 0.3               # giây giữ lại trước/sau mỗi đoạn có tiếng
+# Pool API key
+GENAI_LOCK = threading.Lock()   # genai.configure là cấu hình của cả process: mọi pool (hệ thống lẫn key riêng) dùng chung khóa này
+KEY_COOLDOWN = 60        # giây nghỉ mặc định của (key, model) sau lỗi 429
+FILE_OWNERS_MAX = 5000   # số file Gemini nhớ key sở hữu trong mỗi pool
+RATE_WINDOW = 60         # cửa sổ đếm request/token để chọn key ít tải nhất
+DEFAULT_FALLBACK_MODELS = ["models/gemini-1.5-flash"]
+# Bộ nhớ kết quả trên đĩa
+MEMO_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "responses.sqlite")
+MEMO_MAX_BYTES = 200 * 1024 * 1024   # vượt quá thì xóa bản ít dùng gần đây nhất
+# Context cache cho Chat / chạy tiếp
+CONTEXT_CACHE_TTL = 15 * 60   # giây; được gia hạn mỗi khi session còn dùng
+CHAT_HISTORY_TURNS = 6        # số cặp hỏi-đáp gần nhất gửi kèm mỗi câu hỏi
+# Chat trả lời từ bản gỡ băng (tra cứu cục bộ, không gửi file)
+RETRIEVAL_TOP_K = 8            # số đoạn [mm:ss] gửi kèm câu hỏi
+RETRIEVAL_MIN_COVERAGE = 0.5   # tỉ lệ từ khóa của câu hỏi có trong các đoạn tìm được; thấp hơn thì hỏi trên cả file
+RETRIEVAL_NO_ANSWER = "KHÔNG ĐỦ THÔNG TIN"
+BM25_K1, BM25_B = 1.5, 0.75
+# Đo đạc
+METRICS_LOG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "metrics.jsonl")   # None = tắt log
+METRICS_LOG_MAX_BYTES = 50 * 1024 * 1024   # vượt quá thì đổi tên thành .1 và ghi file mới
+METRICS_CALLS_KEPT = 200                   # số request gần nhất giữ chi tiết trong bản tóm tắt
+TS_PATTERN = re.compile(r"\[(\d{1,3}):(\d{2})(?::(\d{2}))?\]")
+# Kho kết quả dạng phân đoạn
+LINE_TS_PATTERN = re.compile(r"^\s*(?:[-*]\s+)?\**\s*\[(\d{1,3}):(\d{2})(?::(\d{2}))?\]\**\s*")
+SPEAKER_PATTERN = re.compile(r"^\**([^:\[\]*\n]{1,40}?)\**\s*:(?:\s*\*\*(?=\s|$))?\s*")   # "Tên:** nội dung" bỏ cả ** đóng
+
+# --- 2. HÀM LÕI ---
+def is_quota_error(e):
+    msg = str(e)
+    return "429" in msg or "Quota" in msg or "RESOURCE_EXHAUSTED" in msg
+
+def is_not_found_error(e):
+    msg = str(e)
+    return "404" in msg or "Not Found" in msg
+
+def retry_after(e, default=KEY_COOLDOWN):
+    m = re.search(r"retry in ([\d.]+)s|retry_delay\s*\{\s*seconds:\s*(\d+)", str(e))
+    return float(m.group(1) or m.group(2)) if m else default
+
+def mask_key(key):
+    return f"…{key[-4:]}" if key else "?"
+
+# --- Đo đạc: thời gian từng giai đoạn, token từng request, số lần retry/fallback ---
+class RunMetrics:
+    # Số liệu của một lần chạy (một job, một file batch, hay các thao tác trên giao diện).
+    # Ghi từ nhiều luồng; summary() trả về dict JSON để lưu cùng job/checkpoint.
+    def __init__(self, name=""):
+        self.name, self.started = name, time.time()
+        self._lock = threading.Lock()
+        self.stages, self.calls = {}, []
+        self.counters = {"retries": 0, "fallbacks": 0, "quota_errors": 0, "not_found": 0, "memo_hits": 0, "cache_hits": 0, "upload_reuses": 0}
+
+    def add_stage(self, stage, seconds):
+        with self._lock:
+            s = self.stages.setdefault(stage, {"count": 0, "seconds": 0.0, "max": 0.0})
+            s["count"] += 1; s["seconds"] += seconds; s["max"] = max(s["max"], seconds)
+
+    def add_call(self, call):
+        with self._lock: self.calls.append(call)
+
+    def count(self, name, n=1):
+        with self._lock: self.counters[name] = self.counters.get(name, 0) + n
+
+    def summary(self):
+        with self._lock:
+            return {"name": self.name, "elapsed": round(time.time() - self.started, 2),
+                    "stages": {k: {"count": v["count"], "seconds": round(v["seconds"], 3), "max": round(v["max"], 3)} for k, v in self.stages.items()},
+                    "tokens": {k: sum(c[k] for c in self.calls) for k in ("prompt", "output", "cached")},
+                    "requests": len(self.calls), "counters": dict(self.counters), "calls": self.calls[-METRICS_CALLS_KEPT:]}
+
+_current_metrics = contextvars.ContextVar("current_metrics", default=None)
+_log_lock = threading.Lock()
+
+@contextmanager
+def collect_metrics(metrics):
+    # Mọi timed()/record_call() trong khối này (kể cả ở worker thread tạo qua submit_ctx) ghi vào `metrics`
+    token = _current_metrics.set(metrics)
+    try: yield metrics
+    finally: _current_metrics.reset(token)
+
+def submit_ctx(executor, fn, *args, **kwargs):
+    # Worker thread không thừa hưởng contextvars: chạy fn trong bản sao context để số liệu về đúng lần chạy
+    return executor.submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+def log_event(event, **fields):
+    # Log có cấu trúc: mỗi dòng một JSON {ts, run, event, ...}
+    if not METRICS_LOG_PATH: return
+    m = _current_metrics.get()
+    line = json.dumps({"ts": round(time.time(), 3), "run": m.name if m else None, "event": event, **fields}, ensure_ascii=False, default=str)
+    try:
+        with _log_lock:
+            if os.path.exists(METRICS_LOG_PATH) and os.path.getsize(METRICS_LOG_PATH) > METRICS_LOG_MAX_BYTES:
+                os.replace(METRICS_LOG_PATH, METRICS_LOG_PATH + ".1")
+            os.makedirs(os.path.dirname(METRICS_LOG_PATH), exist_ok=True)
+            with open(METRICS_LOG_PATH, "a", encoding="utf-8") as f: f.write(line + "\n")
+    except OSError: pass
+
+@contextmanager
+def timed(stage, **fields):
+    started = time.monotonic()
+    try: yield
+    finally:
+        seconds = time.monotonic() - started
+        m = _current_metrics.get()
+        if m is not None: m.add_stage(stage, seconds)
+        log_event("stage", stage=stage, seconds=round(seconds, 4), **fields)
+
+def count_event(name, **fields):
+    m = _current_metrics.get()
+    if m is not None: m.count(name)
+    log_event("count", name=name, **fields)
+
+def record_call(model, via, seconds, ttft, usage):
+    # via: "api" (gửi đủ file), "context_cache" (chỉ gửi lượt mới)
+    call = {"model": model, "via": via, "seconds": round(seconds, 3), "ttft": round(ttft or 0.0, 3),
+            **{k: usage.get(k, 0) or 0 for k in ("prompt", "output", "cached")}}
+    m = _current_metrics.get()
+    if m is not None: m.add_call(call)
+    log_event("call", **call)
+
+class KeyPool:
+    # Theo dõi request/token trong RATE_WINDOW giây, số request đang chạy và thời gian nghỉ sau 429
+    # cho từng cặp (key, model). Luôn chọn key khỏe, ít tải nhất.
+    # File Gemini thuộc project của key đã upload nó: request kèm file chỉ gửi bằng đúng key đó (file_owner).
+    def __init__(self, keys=()):
+        self._lock = threading.Lock()
+        self._stats, self._file_owners = {}, {}
+        self.keys = []
+        self.set_keys(keys)
+
+    def set_keys(self, keys):
+        self.keys = [k for k in dict.fromkeys(keys) if k]
+
+    def _stat(self, key, model):
+        return self._stats.setdefault((key, model), {"calls": deque(), "inflight": 0, "cooldown_until": 0.0, "quota_errors": 0})
+
+    def _load(self, stat, now):
+        while stat["calls"] and stat["calls"][0][0] < now - RATE_WINDOW:
+            stat["calls"].popleft()
+        return (stat["inflight"] + len(stat["calls"]), sum(t for _, t in stat["calls"]))
+
+    def acquire(self, model, exclude=(), only=None):
+        # only: chỉ nhận đúng key này (vd. key đã tạo context cache); đang nghỉ sau 429 thì trả None
+        with self._lock:
+            now = time.time()
+            ready = [(self._load(self._stat(k, model), now), i, k) for i, k in enumerate(self.keys)
+                     if k not in exclude and (only is None or k == only) and self._stat(k, model)["cooldown_until"] <= now]
+            if not ready: return None
+            key = min(ready)[2]
+            self._stat(key, model)["inflight"] += 1
+            return key
+
+    def release(self, key, model, tokens=0, cooldown=None):
+        with self._lock:
+            stat = self._stat(key, model)
+            stat["inflight"] = max(0, stat["inflight"] - 1)
+            stat["calls"].append((time.time(), tokens))
+            if cooldown:
+                stat["cooldown_until"] = time.time() + cooldown
+                stat["quota_errors"] += 1
+
+    def set_file_owner(self, files, key):
+        with self._lock:
+            for f in files: self._file_owners[f.name] = key
+            while len(self._file_owners) > FILE_OWNERS_MAX: self._file_owners.pop(next(iter(self._file_owners)))
+
+    def file_owner(self, contents):
+        # Key đã upload file có trong contents, None nếu contents không kèm file của pool này
+        with self._lock:
+            return next((self._file_owners[n] for n in file_names(contents) if n in self._file_owners), None)
+
+    def best_key(self):
+        with self._lock:
+            now = time.time()
+            loads = [(sum(self._load(s, now)[0] for (k, _), s in self._stats.items() if k == key), i, key) for i, key in enumerate(self.keys)]
+        return min(loads)[2] if loads else None
+
+    def with_key(self, key, fn):
+        # genai.configure là cấu hình toàn cục: khóa chung GENAI_LOCK để các luồng/pool song song không dùng nhầm key của nhau.
+        # Chỉ gọi ở đây (tạo client gắn key); request chạy sau đó không phụ thuộc cấu hình toàn cục.
+        with GENAI_LOCK:
+            genai.configure(api_key=key)
+            return fn()
+
+    def bind_model(self, key, model_name, **kwargs):
+        # Gắn client cho model ngay trong lúc giữ khóa, request sau đó chạy không cần khóa
+        def make():
+            model = genai.GenerativeModel(model_name, **kwargs)
+            model._client = genai_client.get_default_generative_client()
+            return model
+        return self.with_key(key, make)
+
+    def bind_files(self, key):
+        # Client upload/get_file gắn đúng key: genai.upload_file dùng cấu hình toàn cục, có thể đang là key của session khác
+        return self.with_key(key, genai_client.get_default_file_client)
+
+    def bind_cached_model(self, key, cache_name):
+        def make():
+            model = genai.GenerativeModel.from_cached_content(cache_name)
+            model._client = genai_client.get_default_generative_client()
+            return model
+        return self.with_key(key, make)
+
+    def snapshot(self):
+        with self._lock:
+            now = time.time()
+            rows = []
+            for (key, model), stat in sorted(self._stats.items(), key=lambda x: (self.keys.index(x[0][0]) if x[0][0] in self.keys else 99, x[0][1])):
+                reqs, tokens = self._load(stat, now)
+                wait_s = max(0, stat["cooldown_until"] - now)
+                rows.append({"Key": mask_key(key), "Model": format_model_name(model), "Req/phút": reqs, "Token/phút": tokens,
+                             "Lỗi 429": stat["quota_errors"], "Trạng thái": f"⏸️ nghỉ {wait_s:.0f}s" if wait_s else "✅"})
+            return rows
+
+@lru_cache(maxsize=None)
+def get_key_pool():
+    # Pool key hệ thống, dùng chung cả process
+    return KeyPool()
+
+def content_fingerprint(contents):
+    # Phần chữ của contents; File bỏ qua vì nội dung file đã nằm trong digests
+    out = []
+    for c in contents:
+        if isinstance(c, str): out.append(c)
+        elif isinstance(c, dict): out.append({"role": c.get("role"), "parts": content_fingerprint(c.get("parts", []))})
+    return out
+
+def file_names(contents):
+    # Tên các File (không phải chữ) trong contents, kể cả trong parts của các lượt chat
+    out = []
+    for c in contents:
+        if isinstance(c, dict): out.extend(file_names(c.get("parts", [])))
+        elif not isinstance(c, str) and hasattr(c, "name"): out.append(c.name)
+    return out
+
+class ResponseStore:
+    # Lưu kết quả model vào SQLite, khóa = hash(nội dung file + prompt + model + cấu hình).
+    # Đếm hit/miss cho cả process; vượt MEMO_MAX_BYTES thì xóa theo LRU.
+    def __init__(self, path=MEMO_PATH, max_bytes=MEMO_MAX_BYTES):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path, self.max_bytes = path, max_bytes
+        self.hits = self.misses = 0
+        self._lock = threading.Lock()
+        with self._db() as db:
+            db.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, model TEXT, text TEXT, size INTEGER, created REAL, accessed REAL)")
+
+    def _db(self):
+        return closing(sqlite3.connect(self.path, timeout=30))
+
+    @staticmethod
+    def make_key(model_name, contents, digests, generation_config=None, safety_settings=None, **_):
+        payload = [model_name, content_fingerprint(contents), list(digests), repr(generation_config), safety_settings]
+        return hashlib.sha256(json.dumps(payload, ensure_ascii=False, default=str).encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        with self._lock, self._db() as db:
+            row = db.execute("SELECT text FROM responses WHERE key = ?", (key,)).fetchone()
+            if row:
+                db.execute("UPDATE responses SET accessed = ? WHERE key = ?", (time.time(), key)); db.commit()
+                self.hits += 1
+                return row[0]
+            self.misses += 1
+            return None
+
+    def put(self, key, model_name, text):
+        # Không lưu kết quả rỗng hoặc lỗi để lần sau còn gọi lại
+        if not text or not text.strip() or "[Lỗi:" in text: return
+        size = len(text.encode("utf-8"))
+        with self._lock, self._db() as db:
+            now = time.time()
+            db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)", (key, model_name, text, size, now, now))
+            total = db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+            for old_key, old_size in db.execute("SELECT key, size FROM responses ORDER BY accessed").fetchall():
+                if total <= self.max_bytes: break
+                db.execute("DELETE FROM responses WHERE key = ?", (old_key,)); total -= old_size
+            db.commit()
+
+    def stats(self):
+        with self._lock, self._db() as db:
+            count, size = db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        return {"hits": self.hits, "misses": self.misses, "entries": count, "bytes": size}
+
+    def clear(self):
+        with self._lock, self._db() as db:
+            db.execute("DELETE FROM responses"); db.commit()
+
+@lru_cache(maxsize=None)
+def get_response_store():
+    # Một store cho cả process (mọi session Streamlit / mọi worker batch)
+    return ResponseStore()
+
+def generate_with_failover(pool, models, contents, placeholder=None, usage=None, memo=None, **kwargs):
+    # Thử lần lượt mọi key khỏe của model đầu; hết key (429) hoặc model không tồn tại (404)
+    # thì xuống model kế tiếp trong chuỗi. Trả về (text, ttft, model đã dùng).
+    # memo = (ResponseStore, digests): mỗi model trong chuỗi đều tra bộ nhớ trước khi gọi API.
+    last_err = None
+    usage = {} if usage is None else usage
+    owner = pool.file_owner(contents)   # có file thì chỉ key sở hữu file đọc được
+    for i, model_name in enumerate(models):
+        if i: count_event("fallbacks", model=model_name)
+        if memo:
+            memo_key = ResponseStore.make_key(model_name, contents, memo[1], **kwargs)
+            text = memo[0].get(memo_key)
+            if text is not None:
+                count_event("memo_hits", model=model_name)
+                if placeholder: placeholder.markdown(text)
+                return text, 0.0, model_name
+        tried = set()
+        while (key := pool.acquire(model_name, exclude=tried, only=owner)) is not None:
+            if tried: count_event("retries", model=model_name)
+            tried.add(key)
+            usage.clear()
+            started = time.monotonic()
+            try:
+                with timed("generate", model=model_name):
+                    text, ttft = generate_text(pool.bind_model(key, model_name), contents, placeholder, usage=usage, **kwargs)
+            except Exception as e:
+                if is_quota_error(e):
+                    count_event("quota_errors", model=model_name)
+                    pool.release(key, model_name, cooldown=retry_after(e)); last_err = e; continue
+                pool.release(key, model_name)
+                if is_not_found_error(e):
+                    count_event("not_found", model=model_name); last_err = e; break
+                raise
+            record_call(model_name, "api", time.monotonic() - started, ttft, usage)
+            pool.release(key, model_name, tokens=usage.get("total", 0))
+            if memo: memo[0].put(memo_key, model_name, text)
+            return text, ttft, model_name
+    raise last_err or RuntimeError("429 Quota: không còn API key khả dụng.")
+
+def ensure_context_cache(pool, model_name, files, digests, current=None):
+    # Tạo (hoặc dùng lại) CachedContent chứa các file đã upload để mỗi câu hỏi/vòng chạy tiếp
+    # không phải trả lại toàn bộ token đầu vào. Model/file không hỗ trợ cache thì ghi nhớ "failed" để khỏi thử lại.
+    now = time.time()
+    if current and current["model"] == model_name and current["digests"] == digests:
+        if current.get("failed") or current["expires"] - now > CONTEXT_CACHE_TTL / 2: return current
+        if current["expires"] - now > 30:
+            try:
+                pool.with_key(current["key"], lambda: genai_caching.CachedContent.get(current["name"]).update(
+                    ttl=datetime.timedelta(seconds=CONTEXT_CACHE_TTL)))
+                return dict(current, expires=now + CONTEXT_CACHE_TTL)
+            except Exception: pass
+    key = pool.file_owner(files) or pool.best_key()
+    try:
+        with timed("context_cache", model=model_name):
+            cache = pool.with_key(key, lambda: genai_caching.CachedContent.create(
+                model=model_name, contents=list(files), system_instruction=STRICT_RULES,
+                ttl=datetime.timedelta(seconds=CONTEXT_CACHE_TTL)))
+        return {"name": cache.name, "key": key, "model": model_name, "digests": digests, "expires": now + CONTEXT_CACHE_TTL}
+    except Exception as e:
+        return {"failed": True, "error": str(e), "model": model_name, "digests": digests}
+
+def generate_with_context(pool, models, cache, turns, fallback_contents, placeholder=None, stats=None, usage=None, memo=None, **kwargs):
+    # Gửi `turns` (không kèm file) lên context cache; cache lỗi/không có thì gửi đầy đủ qua pool.
+    usage = {} if usage is None else usage
+    if cache and not cache.get("failed") and cache["key"] in pool.keys:
+        if memo:
+            memo_key = ResponseStore.make_key(cache["model"], fallback_contents, memo[1], **kwargs)
+            text = memo[0].get(memo_key)
+            if text is not None:
+                count_event("memo_hits", model=cache["model"])
+                if placeholder: placeholder.markdown(text)
+                return text, 0.0, cache["model"]
+        # Cache gắn với key đã tạo nó: key đó đang nghỉ sau 429 thì lượt này gửi đầy đủ qua key khác
+        if pool.acquire(cache["model"], only=cache["key"]) is not None:
+            try:
+                started = time.monotonic()
+                with timed("generate", model=cache["model"]):
+                    text, ttft = generate_text(pool.bind_cached_model(cache["key"], cache["name"]), turns, placeholder, usage=usage, **kwargs)
+                record_call(cache["model"], "context_cache", time.monotonic() - started, ttft, usage)
+                count_event("cache_hits", model=cache["model"])
+                pool.release(cache["key"], cache["model"], tokens=usage.get("total", 0))
+                if memo: memo[0].put(memo_key, cache["model"], text)
+                if stats is not None:
+                    stats["hits"] += 1; stats["saved_tokens"] += usage.get("cached", 0)
+                return text, ttft, cache["model"]
+            except Exception as e:
+                # 429 chỉ là key đang nghỉ, cache vẫn dùng lại được khi hết cooldown; lỗi khác mới bỏ hẳn cache
+                quota = is_quota_error(e)
+                pool.release(cache["key"], cache["model"], cooldown=retry_after(e) if quota else None)
+                if not quota: cache["failed"] = True
+    if stats is not None: stats["misses"] += 1
+    return generate_with_failover(pool, models, fallback_contents, placeholder, usage=usage, memo=memo, **kwargs)
+
+def build_chat_turns(history, question, files=None):
+    # Lịch sử có giới hạn + câu hỏi mới; files (nếu có) gắn vào lượt user đầu tiên
+    turns = [{"role": "user" if m["role"] == "user" else "model", "parts": [m["content"]]} for m in history[-CHAT_HISTORY_TURNS * 2:]]
+    turns.append({"role": "user", "parts": [f"Trả lời: {question}"]})
+    if turns[0]["role"] == "model": turns = turns[1:]
+    if files: turns[0] = {"role": "user", "parts": list(files) + turns[0]["parts"]}
+    return turns
+
+def get_optimized_models():
+    # Danh sách cứng để đảm bảo luôn có lựa chọn
+    return ["models/gemini-3.0-flash-preview", "models/gemini-2.0-flash-exp", "models/gemini-1.5-flash", "models/gemini-1.5-pro"]
+
+def format_model_name(name):
+    return name.replace("models/", "").replace("-preview", " (Pre)").replace("-latest", "").upper()
+
+def wait_until_active(file, deadline, files_client, on_poll=None):
+    # Poll theo exponential backoff + jitter thay vì sleep(1) cố định
+    delay = 1.0
+    while file.state.name == "PROCESSING":
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError(f"File {file.display_name or file.name} xử lý quá {UPLOAD_TIMEOUT}s.")
+        time.sleep(min(remaining, random.uniform(delay / 2, delay)))
+        delay = min(delay * 2, POLL_MAX_DELAY)
+        file = genai_file_types.File(files_client.get_file(name=file.name))
+        if on_poll: on_poll(file)
+    if file.state.name == "FAILED":
+        raise RuntimeError(f"File {file.display_name or file.name} xử lý thất bại trên server.")
+    return file
+
+def upload_to_gemini(files_client, path, display_name=None, timeout=UPLOAD_TIMEOUT, on_status=None):
+    # files_client: KeyPool.bind_files(key)
+    deadline = time.monotonic() + timeout
+    mime_type, _ = mimetypes.guess_type(path)
+    if on_status: on_status("⬆️ Đang tải lên...")
+    with timed("upload", bytes=os.path.getsize(path)):
+        file = genai_file_types.File(files_client.create_file(path=path, mime_type=mime_type or "application/octet-stream",
+                                                              display_name=display_name))
+    started = time.monotonic()
+    if on_status: on_status("⚙️ Server đang xử lý...")
+    poll = (lambda f: on_status(f"⚙️ Server đang xử lý ({time.monotonic() - started:.0f}s)...")) if on_status else None
+    with timed("poll"):
+        return wait_until_active(file, deadline, files_client, on_poll=poll)
+
+def content_digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+class UploadCache:
+    # sha256(nội dung) -> (tên file trên Gemini, hạn dùng). Có TTL + LRU, an toàn đa luồng.
+    def __init__(self, ttl=UPLOAD_CACHE_TTL, max_entries=UPLOAD_CACHE_MAX):
+        self.ttl, self.max_entries = ttl, max_entries
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, digest):
+        with self._lock:
+            item = self._items.get(digest)
+            if not item: return None
+            if item["expires"] <= time.time():
+                del self._items[digest]; return None
+            self._items.move_to_end(digest)
+            return item["name"]
+
+    def put(self, digest, file):
+        expires = time.time() + self.ttl
+        exp_time = getattr(file, "expiration_time", None)
+        if exp_time:
+            try: expires = min(expires, exp_time.timestamp() - 3600)
+            except: pass
+        with self._lock:
+            self._items[digest] = {"name": file.name, "expires": expires}
+            self._items.move_to_end(digest)
+            while len(self._items) > self.max_entries:
+                self._items.popitem(last=False)
+
+    def drop(self, digest):
+        with self._lock: self._items.pop(digest, None)
+
+    def __len__(self):
+        return len(self._items)
+
+@lru_cache(maxsize=None)
+def get_upload_cache():
+    return UploadCache()
+
+def get_cached_file(files_client, cache, digest, deadline):
+    # Kiểm tra lại với server (bằng key của pool đang dùng) trước khi dùng: file có thể đã hết hạn/bị xóa hoặc thuộc key khác
+    name = cache.get(digest)
+    if not name: return None
+    try:
+        return wait_until_active(genai_file_types.File(files_client.get_file(name=name)), deadline, files_client)
+    except Exception:
+        cache.drop(digest)
+        return None
+
+def upload_many(sources, pool, on_update=None, max_workers=UPLOAD_WORKERS, timeout=UPLOAD_TIMEOUT, cache=None, key=None):
+    # sources: [(tên hiển thị, bytes, sha256)]. Tải song song, giữ nguyên thứ tự, bằng `key` (mặc định key ít tải nhất
+    # của `pool`); pool ghi nhớ key này là chủ các file để mọi request kèm file sau đó đi đúng key.
+    # Thời gian chờ ~ file chậm nhất chứ không phải tổng. File trùng nội dung đã có trong cache thì bỏ qua upload.
+    # Worker thread không được gọi st.*, nên chỉ ghi vào `status`; luồng chính vẽ lại qua on_update.
+    names = [n for n, _, _ in sources]
+    status = {n: "⏳ Đang chờ..." for n in names}
+    results = [None] * len(sources)
+    key = key or pool.best_key()
+    files_client = pool.bind_files(key)
+
+    def job(i):
+        name, data, digest = sources[i]
+        def set_status(s): status[name] = s
+        if cache is not None:
+            set_status("🔎 Kiểm tra cache...")
+            cached = get_cached_file(files_client, cache, digest, time.monotonic() + timeout)
+            if cached:
+                count_event("upload_reuses")
+                results[i] = cached; set_status("♻️ Dùng lại file đã tải"); return
+        ext = os.path.splitext(name)[1] or ".txt"
+        with timed("temp_write", bytes=len(data)), tempfile.NamedTemporaryFile(delete=False, suffix=ext) as tmp:
+            tmp.write(data)
+        try:
+            results[i] = upload_to_gemini(files_client, tmp.name, name, timeout, set_status)
+        finally:
+            os.remove(tmp.name)
+        if cache is not None: cache.put(digest, results[i])
+        set_status("✅ Sẵn sàng")
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(sources)))) as ex:
+        pending = {submit_ctx(ex, job, i): i for i in range(len(sources))}
+        try:
+            while pending:
+                done, _ = wait(pending, timeout=0.5, return_when=FIRST_COMPLETED)
+                for fut in done:
+                    i = pending.pop(fut)
+                    if fut.exception():
+                        status[names[i]] = f"❌ {fut.exception()}"
+                        raise fut.exception()
+                if on_update: on_update(dict(status))
+        finally:
+            for fut in pending: fut.cancel()
+    pool.set_file_owner(results, key)
+    return results
+
+# --- Gỡ băng phân đoạn ---
+def ts_seconds(m):
+    a, b, c = m.group(1), m.group(2), m.group(3)
+    return int(a) * 3600 + int(b) * 60 + int(c) if c else int(a) * 60 + int(b)
+
+def fmt_ts(sec):
+    sec = max(0, int(sec))
+    return f"[{sec // 60:02d}:{sec % 60:02d}]"
+
+def shift_timestamps(text, offset):
+    if not offset: return text
+    return TS_PATTERN.sub(lambda m: fmt_ts(ts_seconds(m) + offset), text)
+
+def probe_duration(name, data):
+    # WAV đọc trực tiếp; định dạng khác cần ffprobe
+    if name.lower().endswith(".wav"):
+        try:
+            with wave.open(io.BytesIO(data)) as w: return w.getnframes() / w.getframerate()
+        except: pass
+    if not shutil.which("ffprobe"): return None
+    with tempfile.NamedTemporaryFile(delete=False, suffix=os.path.splitext(name)[1]) as tmp:
+        tmp.write(data)
+    try:
+        out = subprocess.run(["ffprobe", "-v", "error", "-show_entries", "format=duration", "-of", "csv=p=0", tmp.name],
+                             capture_output=True, text=True, timeout=120)
+        return float(out.stdout.strip())
+    except: return None
+    finally: os.remove(tmp.name)
+
+def plan_windows(duration, minutes=SEGMENT_MINUTES, overlap=SEGMENT_OVERLAP):
+    # [start, end) là phần đoạn "sở hữu"; [from, to] là phần thực sự gửi/yêu cầu model nghe (có chồng lấn)
+    step = minutes * 60
+    windows, start = [], 0
+    while start < duration:
+        end = min(start + step, duration)
+        windows.append({"start": start, "end": end, "from": max(0, start - overlap), "to": min(duration, end + overlap)})
+        start = end
+    return windows
+
+def cut_segments(name, data, windows):
+    # Cắt file thành các đoạn mono nhỏ bằng ffmpeg. Trả về None nếu máy không có ffmpeg.
+    if not shutil.which("ffmpeg"): return None
+    with tempfile.NamedTemporaryFile(delete=False, suffix=os.path.splitext(name)[1]) as tmp:
+        tmp.write(data)
+    def cut(w):
+        out = subprocess.run(["ffmpeg", "-v", "error", "-ss", str(w["from"]), "-t", str(w["to"] - w["from"]), "-i", tmp.name,
+                              "-vn", "-ac", "1", "-ar", "16000", "-c:a", "libmp3lame", "-b:a", "32k", "-f", "mp3", "pipe:1"],
+                             capture_output=True, timeout=600, check=True).stdout
+        return (f"{os.path.splitext(name)[0]}_{int(w['from'])}.mp3", out, content_digest(out))
+    try:
+        with ThreadPoolExecutor(max_workers=SEGMENT_WORKERS) as pool:
+            return list(pool.map(cut, windows))
+    except Exception: return None
+    finally: os.remove(tmp.name)
+
+def segment_prompt(w, is_cut):
+    if is_cut:
+        scope = "Đây là MỘT ĐOẠN cắt từ bản ghi dài. Gỡ băng TOÀN BỘ đoạn này, mốc giờ tính từ đầu đoạn [00:00]."
+    else:
+        scope = f"CHỈ gỡ băng phần từ {fmt_ts(w['from'])} đến {fmt_ts(w['to'])} của file ghi âm. Mốc giờ theo file gốc."
+    return f"""
+    {STRICT_RULES}
+    NHIỆM VỤ: Gỡ băng NGUYÊN VĂN 100%. {scope}
+    YÊU CẦU:
+    1. Bắt đầu mỗi câu bằng [Phút:Giây].
+    2. Viết lại chính xác từng từ.
+    3. Định danh: 'Người nói 1', 'Người nói 2'.
+    4. Ngôn ngữ: Tiếng Việt.
+    """
+
+def to_absolute(text, w, is_cut):
+    # Đoạn cắt rời luôn có mốc tương đối. Khi hỏi theo khoảng giờ, model đôi khi vẫn đếm lại từ 0:
+    # nếu mọi mốc đều nhỏ hơn điểm bắt đầu thì coi là tương đối và dịch đi.
+    if is_cut: return shift_timestamps(text, w["from"])
+    stamps = [ts_seconds(m) for m in TS_PATTERN.finditer(text)]
+    if stamps and w["from"] > 0 and max(stamps) < w["from"]:
+        return shift_timestamps(text, w["from"])
+    return text
+
+def split_utterances(text, default_ts=0):
+    # Gom dòng không có mốc giờ vào câu phía trước: [(giây, nội dung)]. Nhận cả mốc in đậm / gạch đầu dòng
+    # ("**[mm:ss] Người nói 1:**", "- [mm:ss]") như TranscriptStore.
+    items = []
+    for line in text.strip().split("\n"):
+        if not line.strip(): continue
+        m = LINE_TS_PATTERN.match(line)
+        if m or not items:
+            items.append([ts_seconds(m) if m else default_ts, line.strip()])
+        else:
+            items[-1][1] += "\n" + line.strip()
+    return items
+
+def normalize_utterance(line):
+    return re.sub(r"\W+", " ", TS_PATTERN.sub("", line)).strip().lower()
+
+def stitch_segments(windows, texts):
+    # Ghép theo thứ tự thời gian: mỗi đoạn chỉ giữ câu nằm trong [start, end) của nó,
+    # rồi bỏ câu mở đầu đoạn (trong SEGMENT_OVERLAP giây) trùng nội dung với đuôi đoạn trước.
+    out, tail = [], set()
+    last = len(windows) - 1
+    for i, w in enumerate(windows):
+        text = texts.get(i)
+        if text is None:
+            out.append(f"[... Đoạn {fmt_ts(w['start'])}–{fmt_ts(w['end'])} chưa gỡ xong ...]")
+            tail = set(); continue
+        kept = set()
+        for t, line in split_utterances(text, w["start"]):
+            if (i > 0 and t < w["start"]) or (i < last and t >= w["end"]): continue
+            key = normalize_utterance(line)
+            if key and t < w["start"] + SEGMENT_OVERLAP and key in tail: continue
+            out.append(line)
+            if key and t >= w["end"] - SEGMENT_OVERLAP: kept.add(key)
+        tail = kept
+    return "\n".join(out)
+
+class LiveText:
+    # Thay st.empty() cho job chạy nền: stream_response ghi phần đang sinh vào streams[label] (kèm thời gian tới
+    # token đầu tiên) để giao diện poll đọc; close() khi đoạn/mục/lượt xong thì bỏ đi.
+    def __init__(self, streams, label):
+        self.streams, self.label, self.started, self.ttft = streams, label, time.monotonic(), None
+
+    def markdown(self, text):
+        if self.ttft is None: self.ttft = time.monotonic() - self.started
+        self.streams[self.label] = {"text": text[-LIVE_TAIL_CHARS:], "ttft": round(self.ttft, 2)}
+
+    def close(self):
+        self.streams.pop(self.label, None)
+
+def transcribe_window(key_pool, models, w, files, is_cut, gen_config, memo=None, live_box=None):
+    box = live_box(f"Đoạn {fmt_ts(w['start'])}–{fmt_ts(w['end'])}") if live_box else None
+    try:
+        text, _, _ = generate_with_failover(key_pool, models, [segment_prompt(w, is_cut)] + files, box, memo=memo,
+                                            generation_config=gen_config, safety_settings=SAFETY_SETTINGS)
+    finally:
+        if box: box.close()
+    return to_absolute(text, w, is_cut)
+
+class Cancelled(Exception):
+    # Job bị người dùng hủy giữa chừng (state vẫn giữ phần đã xong)
+    pass
+
+def run_segment_job(job, key_pool, models, gen_config, on_update=None, max_workers=SEGMENT_WORKERS, store=None, cancel=None,
+                    live_box=None):
+    # Gỡ song song các đoạn chưa xong. job["done"] giữ kết quả nên lỗi giữa chừng có thể chạy tiếp.
+    # cancel (threading.Event): bỏ các đoạn chưa bắt đầu, đợi đoạn đang chạy xong (giữ kết quả, token đã trả) rồi raise Cancelled.
+    todo = [i for i in range(len(job["windows"])) if i not in job["done"]]
+    job["errors"] = {}
+    if not todo: return job
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(todo)))) as pool:
+        pending = {submit_ctx(pool, transcribe_window, key_pool, models, job["windows"][i], job["files"][i], job["is_cut"], gen_config,
+                               (store, job["digests"][i]) if store else None, live_box): i for i in todo}
+        def collect(done):
+            for fut in done:
+                i = pending.pop(fut)
+                try: job["done"][i] = fut.result()
+                except Exception as e: job["errors"][i] = str(e)
+        while pending:
+            if cancel is not None and cancel.is_set():
+                for fut in pending: fut.cancel()
+                collect([fut for fut in wait(pending).done if not fut.cancelled()])
+                if on_update: on_update(job)
+                raise Cancelled()
+            collect(wait(pending, timeout=0.5, return_when=FIRST_COMPLETED).done)
+            if on_update: on_update(job)
+    return job
+
+def prepare_segment_job(sources, g_files, pool, minutes=SEGMENT_MINUTES):
+    # Chỉ chia đoạn khi cả bộ là đúng một file audio/video: cắt bằng ffmpeg rồi upload từng đoạn.
+    # Nhiều file (thêm audio khác hoặc tài liệu) thì các đoạn cắt sẽ làm mất phần còn lại, nên trả None như khi
+    # không đo được thời lượng hay không cắt được để gỡ một lượt + chạy tiếp: gửi cả bộ cho mỗi đoạn tốn gấp N lần
+    # token, còn đoán thời lượng thì bắt model gỡ những khoảng giờ có thể không tồn tại.
+    if len(sources) != 1 or not (mimetypes.guess_type(sources[0][0])[0] or "").startswith(("audio/", "video/")): return None
+    name, data, _ = sources[0]
+    duration = probe_duration(name, data)
+    if not duration: return None
+    windows = plan_windows(duration, minutes)
+    if len(windows) == 1:
+        files, digests, chunks = [g_files], [[d for _, _, d in sources]], None
+    else:
+        with timed("cut"): chunks = cut_segments(name, data, windows)
+        if not chunks: return None
+        files = [[f] for f in upload_many(chunks, pool, cache=get_upload_cache(), key=pool.file_owner(g_files))]
+        digests = [[d] for _, _, d in chunks]
+    return {"windows": windows, "files": files, "digests": digests, "is_cut": bool(chunks), "done": {}, "errors": {}}
+
+# --- Kho kết quả ---
+class TranscriptStore:
+    # Kết quả dạng danh sách đoạn {ts, speaker, text, section, raw} thay cho một chuỗi lớn.
+    # append() chỉ phân tích phần mới; text/mermaid/docx... tính lười và nhớ theo version.
+    def __init__(self, text=""):
+        self.segments, self.chunks, self.version = [], [], 0
+        self._section, self._in_fence, self._open = None, False, False
+        self._derived = {}
+        self.builders = {}   # bộ dựng file xuất dạng tăng dần (vd. DOCX), gắn với nội dung hiện tại
+        if text: self.append(text)
+
+    def __bool__(self):
+        return bool(self.segments)
+
+    def append(self, text):
+        if not text or not text.strip(): return []
+        start = len(self.segments)
+        self.chunks.append(text)
+        self._open = False   # mỗi lần nối là một đoạn mới
+        for line in text.split("\n"):
+            self._parse_line(line)
+        self.version += 1
+        return self.segments[start:]
+
+    def replace(self, text):
+        version = self.version
+        self.__init__(text)
+        self.version = version + 1   # version không lùi để yêu cầu xuất file cũ không khớp nội dung mới
+
+    def _parse_line(self, line):
+        stripped = line.strip()
+        if stripped.startswith("```"): self._in_fence = not self._in_fence
+        elif not self._in_fence:
+            if line.startswith("## "):
+                self._section, self._open = line[3:].strip(), False
+                return
+            if not stripped:
+                self._open = False
+                return
+            m = LINE_TS_PATTERN.match(line)
+            if m:
+                rest = line[m.end():]
+                sp = SPEAKER_PATTERN.match(rest)
+                ts = int(m.group(1)) * 3600 + int(m.group(2)) * 60 + int(m.group(3)) if m.group(3) else int(m.group(1)) * 60 + int(m.group(2))
+                self.segments.append({"ts": ts, "speaker": sp.group(1).strip() if sp else None,
+                                      "text": rest[sp.end():] if sp else rest, "section": self._section, "raw": line})
+                self._open = True
+                return
+        if self._open:
+            seg = self.segments[-1]
+            seg["raw"] += "\n" + line; seg["text"] += "\n" + line
+        else:
+            self.segments.append({"ts": None, "speaker": None, "text": line, "section": self._section, "raw": line})
+            self._open = True
+
+    def derived(self, name, fn):
+        # Tính lười, chỉ tính lại khi có nội dung mới
+        hit = self._derived.get(name)
+        if hit and hit[0] == self.version: return hit[1]
+        value = fn(self)
+        self._derived[name] = (self.version, value)
+        return value
+
+    @property
+    def text(self):
+        return self.derived("text", lambda s: "\n\n".join(s.chunks))
+
+    def tail(self, n):
+        return self.text[-n:]
+
+    def sections(self):
+        # [(tên mục hoặc None, [đoạn])] theo thứ tự xuất hiện
+        def build(s):
+            out = []
+            for seg in s.segments:
+                if not out or out[-1][0] != seg["section"]: out.append((seg["section"], []))
+                out[-1][1].append(seg)
+            return out
+        return self.derived("sections", build)
+
+    def content_hash(self, *extra):
+        return self.derived("hash", lambda s: hashlib.sha256(s.text.encode("utf-8")).hexdigest()) + (
+            hashlib.sha256(json.dumps(extra, default=str).encode("utf-8")).hexdigest()[:16] if extra else "")
+
+    def mermaid(self):
+        def find(s):
+            text = s.text
+            return text.split("```mermaid")[1].split("```")[0] if "```mermaid" in text else None
+        return self.derived("mermaid", find)
+
+# --- Tra cứu nhanh trên bản gỡ băng (cho Chat) ---
+# Từ hỏi / hư từ (đã bỏ dấu) không dùng làm từ khóa
+STOP_WORDS = frozenset("""
+a ai anh ay bao ban cac cai chi cho chu co cua cung da dang day de den do duoc em gi hay ho hoi khi khong kia la lam
+ma minh mot nao nay nhe nhieu nhu nhung noi nua o oi ra rat roi sao se tai the thi to toi trong tu va vay ve voi vi
+""".split())
+
+def fold_text(text):
+    # Bỏ dấu tiếng Việt để "giá", "gia", "GIÁ" khớp nhau; đ không tách được bằng NFD nên đổi tay
+    text = unicodedata.normalize("NFD", text.lower().replace("đ", "d"))
+    return "".join(c for c in text if unicodedata.category(c) != "Mn")
+
+def index_terms(text):
+    # Từ đơn (trừ hư từ) + cặp từ liền nhau: tiếng Việt ghép từ theo âm tiết nên cặp từ giữ được nghĩa ("gia ban")
+    words = re.findall(r"\w+", fold_text(text))
+    return [w for w in words if w not in STOP_WORDS] + [f"{a}_{b}" for a, b in zip(words, words[1:])]
+
+class TranscriptIndex:
+    # BM25 trên từng đoạn [mm:ss] của một TranscriptStore. update() chỉ đánh chỉ mục các đoạn mới nối thêm
+    # (mỗi vòng chạy tiếp), store bị replace() thì dựng lại từ đầu.
+    def __init__(self):
+        self._segments, self.docs, self.lengths, self.postings, self.total = None, [], [], {}, 0
+
+    def update(self, store):
+        if store.segments is not self._segments:
+            self.__init__(); self._segments = store.segments
+        for seg in store.segments[len(self.docs):]:
+            terms = index_terms(seg["text"])
+            doc = len(self.docs)
+            self.docs.append(seg); self.lengths.append(len(terms)); self.total += len(terms)
+            for term, tf in Counter(terms).items(): self.postings.setdefault(term, {})[doc] = tf
+        return self
+
+    def search(self, query, k=RETRIEVAL_TOP_K):
+        # Trả về (tối đa k đoạn khớp nhất theo thứ tự thời gian, tỉ lệ từ khóa của câu hỏi có trong các đoạn đó)
+        terms = set(index_terms(query))
+        keywords = {t for t in terms if "_" not in t}
+        if not keywords or not self.docs: return [], 0.0
+        n, avgdl = len(self.docs), self.total / len(self.docs) or 1
+        scores = {}
+        for term in terms:
+            posting = self.postings.get(term)
+            if not posting: continue
+            idf = math.log(1 + (n - len(posting) + 0.5) / (len(posting) + 0.5))
+            for doc, tf in posting.items():
+                norm = tf + BM25_K1 * (1 - BM25_B + BM25_B * self.lengths[doc] / avgdl)
+                scores[doc] = scores.get(doc, 0.0) + idf * tf * (BM25_K1 + 1) / norm
+        top = heapq.nlargest(k, scores, key=scores.get)
+        found = {t for t in keywords if any(d in self.postings.get(t, ()) for d in top)}
+        return [self.docs[d] for d in sorted(top)], len(found) / len(keywords)
+
+def retrieval_prompt(question, hits):
+    excerpts = "\n".join(seg["raw"] for seg in hits)
+    return f"""{STRICT_RULES}
+NHIỆM VỤ: Trả lời câu hỏi CHỈ dựa trên các đoạn trích bản gỡ băng bên dưới, dẫn mốc [mm:ss] của đoạn làm căn cứ.
+Nếu các đoạn trích không đủ để trả lời, chỉ viết đúng: {RETRIEVAL_NO_ANSWER}
+ĐOẠN TRÍCH:
+{excerpts}
+CÂU HỎI: {question}"""
+
+def answer_from_transcript(pool, models, index, history, question, placeholder=None, usage=None, **kwargs):
+    # Chat rẻ: chỉ gửi top-k đoạn trích thay vì cả file, nên token/độ trễ theo độ dài câu hỏi chứ không theo độ dài bản ghi.
+    # Trả về (câu trả lời, các đoạn trích); câu trả lời là None khi độ tin cậy thấp -> người gọi hỏi trên cả file.
+    with timed("retrieval", docs=len(index.docs)):
+        hits, coverage = index.search(question)
+    if not hits or coverage < RETRIEVAL_MIN_COVERAGE:
+        count_event("retrieval_fallbacks", reason="low_coverage", coverage=round(coverage, 2)); return None, hits
+    turns = build_chat_turns(history, question)
+    turns[-1] = {"role": "user", "parts": [retrieval_prompt(question, hits)]}
+    text, _, _ = generate_with_failover(pool, models, turns, placeholder, usage=usage, **kwargs)
+    if RETRIEVAL_NO_ANSWER in text[:len(RETRIEVAL_NO_ANSWER) + 20]:
+        count_event("retrieval_fallbacks", reason="no_answer"); return None, hits
+    count_event("retrieval_answers")
+    return text, hits
+
+# --- Tiền xử lý audio ---
+def decode_pcm(name, data, rate=PREP_SAMPLE_RATE):
+    # Giải mã về mono int16 @ rate. Có ffmpeg thì nhận mọi định dạng, không thì chỉ WAV PCM 16-bit.
+    if shutil.which("ffmpeg"):
+        with tempfile.NamedTemporaryFile(delete=False, suffix=os.path.splitext(name)[1]) as tmp:
+            tmp.write(data)
+        try:
+            out = subprocess.run(["ffmpeg", "-v", "error", "-i", tmp.name, "-vn", "-ac", "1", "-ar", str(rate), "-f", "s16le", "pipe:1"],
+                                 capture_output=True, timeout=1800, check=True).stdout
+            return np.frombuffer(out, dtype=np.int16)
+        except Exception: return None
+        finally: os.remove(tmp.name)
+    if not name.lower().endswith(".wav"): return None
+    try:
+        with wave.open(io.BytesIO(data)) as w:
+            if w.getsampwidth() != 2: return None
+            src_rate, channels = w.getframerate(), w.getnchannels()
+            pcm = np.frombuffer(w.readframes(w.getnframes()), dtype=np.int16).reshape(-1, channels).mean(axis=1)
+    except Exception: return None
+    if src_rate != rate and len(pcm):
+        pcm = np.interp(np.arange(0, len(pcm), src_rate / rate), np.arange(len(pcm)), pcm)
+    return pcm.astype(np.int16)
+
+def detect_speech(pcm, rate=PREP_SAMPLE_RATE):
+    # VAD theo năng lượng: trả về các khoảng [(bắt đầu, kết thúc)] (giây) cần giữ
+    duration = len(pcm) / rate
+    frame = int(rate * PREP_FRAME_MS / 1000)
+    n = len(pcm) // frame
+    if n < 2: return [(0.0, duration)]
+    frames = pcm[:n * frame].astype(np.float32).reshape(n, frame)
+    db = 20 * np.log10(np.sqrt((frames ** 2).mean(axis=1)) / 32768 + 1e-10)
+    voiced = db > max(np.percentile(db, 10) + PREP_MARGIN_DB, PREP_FLOOR_DB)
+    if not voiced.any(): return [(0.0, duration)]
+    edges = np.flatnonzero(np.diff(np.concatenate(([0], voiced.astype(np.int8), [0]))))
+    step = frame / rate
+    regions = []
+    for a, b in zip(edges[::2], edges[1::2]):
+        start, end = max(0.0, a * step - PREP_PAD), min(duration, b * step + PREP_PAD)
+        if regions and start - regions[-1][1] < PREP_MIN_SILENCE:
+            regions[-1] = (regions[-1][0], end)
+        else:
+            regions.append((start, end))
+    return regions
+
+def encode_audio(pcm, rate=PREP_SAMPLE_RATE):
+    # Nén mp3 mono 32 kbps nếu có ffmpeg, không thì WAV mono 16 kHz (vẫn nhỏ hơn nhiều so với WAV stereo 44.1 kHz)
+    if shutil.which("ffmpeg"):
+        try:
+            out = subprocess.run(["ffmpeg", "-v", "error", "-f", "s16le", "-ar", str(rate), "-ac", "1", "-i", "pipe:0",
+                                  "-c:a", "libmp3lame", "-b:a", "32k", "-f", "mp3", "pipe:1"],
+                                 input=pcm.tobytes(), capture_output=True, timeout=1800, check=True).stdout
+            return out, ".mp3"
+        except Exception: pass
+    buf = io.BytesIO()
+    with wave.open(buf, "wb") as w:
+        w.setnchannels(1); w.setsampwidth(2); w.setframerate(rate); w.writeframes(pcm.tobytes())
+    return buf.getvalue(), ".wav"
+
+def preprocess_audio(name, data, rate=PREP_SAMPLE_RATE, trim=True):
+    # Trả về (tên mới, bytes mới, cut list, thống kê) hoặc None nếu không giải mã được.
+    # cut list: [[giây gốc bắt đầu, giây gốc kết thúc, giây bắt đầu trong file đã cắt], ...]
+    # trim=False: chỉ chuyển mã, giữ nguyên khoảng lặng (cut list None)
+    pcm = decode_pcm(name, data, rate)
+    if pcm is None or not len(pcm): return None
+    if not trim:
+        out, ext = encode_audio(pcm, rate)
+        stats = {"orig_bytes": len(data), "new_bytes": len(out), "orig_seconds": len(pcm) / rate, "new_seconds": len(pcm) / rate}
+        return f"{os.path.splitext(name)[0]}_gon{ext}", out, None, stats
+    cuts, parts, pos = [], [], 0.0
+    for start, end in detect_speech(pcm, rate):
+        a, b = int(start * rate), int(end * rate)
+        cuts.append([a / rate, b / rate, pos]); parts.append(pcm[a:b]); pos += (b - a) / rate
+    out, ext = encode_audio(np.concatenate(parts), rate)
+    stats = {"orig_bytes": len(data), "new_bytes": len(out), "orig_seconds": len(pcm) / rate, "new_seconds": pos}
+    return f"{os.path.splitext(name)[0]}_gon{ext}", out, cuts, stats
+
+def remap_seconds(t, cuts):
+    if not cuts: return t
+    start, end, new_start = cuts[max(0, bisect_right([c[2] for c in cuts], t) - 1)]
+    return min(start + max(0, t - new_start), end)
+
+def remap_timestamps(text, cuts):
+    # Đổi mốc [mm:ss] trên file đã cắt khoảng lặng về thời gian của file gốc
+    if not cuts or not text: return text
+    return TS_PATTERN.sub(lambda m: fmt_ts(remap_seconds(ts_seconds(m), cuts)), text)
+
+# --- Phân tích từng mục ---
+def section_prompt(heading, detail_level):
+    return f"{STRICT_RULES}\nNHIỆM VỤ: Phân tích sâu {detail_level} CHỈ cho mục sau, mở đầu bằng đúng tiêu đề này:\n## {heading}\n"
+
+def as_section(heading, text):
+    body = text.strip()
+    return body if body.startswith("## ") else f"## {heading}\n{body}"
+
+def section_text(key_pool, models, h, job, gen_config, memo=None, live_box=None):
+    box = live_box(h) if live_box else None
+    try:
+        return generate_with_failover(key_pool, models, [section_prompt(h, job["detail"])] + job["files"], box, memo=memo,
+                                      generation_config=gen_config, safety_settings=SAFETY_SETTINGS)[0]
+    finally:
+        if box: box.close()
+
+def run_sections(job, key_pool, models, gen_config, on_done=None, max_workers=SECTION_WORKERS, only=None, store=None, cancel=None,
+                 live_box=None):
+    # Mỗi mục là một request riêng (ngân sách token riêng) trên cùng bộ file đã upload.
+    # on_done(heading, job) được gọi ở luồng chính ngay khi từng mục xong.
+    todo = only or [h for h in job["sections"] if h not in job["results"]]
+    for h in todo: job["errors"].pop(h, None)
+    if not todo: return job
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(todo)))) as pool:
+        futs = {submit_ctx(pool, section_text, key_pool, models, h, job, gen_config,
+                           (store, job["digests"]) if store else None, live_box): h for h in todo}
+        def collect(fut):
+            h = futs[fut]
+            try: job["results"][h] = as_section(h, fut.result())
+            except Exception as e: job["errors"][h] = str(e)
+            if on_done: on_done(h, job)
+        finished = set()
+        for fut in as_completed(futs):
+            collect(fut); finished.add(fut)
+            if cancel is not None and cancel.is_set():
+                # Mục đang chạy thì đợi xong và giữ lại, mục chưa bắt đầu thì bỏ
+                for f in futs: f.cancel()
+                for f in wait(set(futs) - finished).done:
+                    if not f.cancelled(): collect(f)
+                raise Cancelled()
+    return job
+
+def merge_sections(job):
+    # Ghép theo đúng thứ tự checkbox, bỏ qua mục lỗi
+    return "\n\n".join(job["results"][h] for h in job["sections"] if h in job["results"])
+
+# --- Xuất file ---
+MD_BOLD = re.compile(r"\*\*(.+?)\*\*")
+MD_NUMBERED = re.compile(r"^\d+[.)]\s+")
+
+def add_md_runs(paragraph, text):
+    # **đậm** -> run đậm, phần còn lại giữ nguyên
+    for i, part in enumerate(MD_BOLD.split(text)):
+        if part: paragraph.add_run(part).bold = i % 2 == 1
+
+class DocxBuilder:
+    # Dựng DOCX tăng dần từ các đoạn đã phân tích: lần xuất sau chỉ thêm các đoạn mới.
+    # Hiểu tiêu đề, danh sách, bảng markdown và chữ đậm.
+    def __init__(self, cut_list=None):
+        self.doc = Document()
+        self.doc.add_heading('BÁO CÁO', 0)
+        self.cut_list, self.count, self.section = cut_list, 0, None
+
+    def update(self, segments):
+        for seg in segments[self.count:]:
+            if seg["section"] and seg["section"] != self.section:
+                self.doc.add_heading(seg["section"], level=2)
+            self.section = seg["section"]
+            self.add_markdown(remap_timestamps(seg["raw"], self.cut_list))
+        self.count = len(segments)
+        return self
+
+    def add_markdown(self, text):
+        lines, i, in_fence = text.split("\n"), 0, False
+        while i < len(lines):
+            line = lines[i]; stripped = line.strip(); i += 1
+            if stripped.startswith("```"): in_fence = not in_fence; continue
+            if in_fence: self.doc.add_paragraph(line); continue
+            if stripped.startswith("|"):
+                rows = [stripped]
+                while i < len(lines) and lines[i].strip().startswith("|"):
+                    rows.append(lines[i].strip()); i += 1
+                self.add_table(rows); continue
+            if line.startswith('# '): self.doc.add_heading(line[2:], level=1)
+            elif line.startswith('### '): self.doc.add_heading(line[4:], level=3)
+            elif stripped.startswith(("- ", "* ")): add_md_runs(self.doc.add_paragraph(style="List Bullet"), stripped[2:])
+            elif MD_NUMBERED.match(stripped): add_md_runs(self.doc.add_paragraph(style="List Number"), MD_NUMBERED.sub("", stripped))
+            elif stripped: add_md_runs(self.doc.add_paragraph(), line)
+
+    def add_table(self, rows):
+        cells = [[c.strip() for c in r.strip("|").split("|")] for r in rows if not re.fullmatch(r"[|:\-\s]+", r)]
+        if not cells: return
+        table = self.doc.add_table(rows=len(cells), cols=max(len(r) for r in cells))
+        table.style = "Table Grid"
+        for r, row in enumerate(cells):
+            for c, value in enumerate(row):
+                add_md_runs(table.cell(r, c).paragraphs[0], value)
+                if r == 0:
+                    for run in table.cell(r, c).paragraphs[0].runs: run.bold = True
+
+    def to_bytes(self):
+        buf = io.BytesIO()
+        self.doc.save(buf)
+        return buf.getvalue()
+
+def timed_cues(segments, cut_list=None):
+    # Các câu có mốc giờ -> [(bắt đầu, kết thúc, người nói, nội dung)]; kết thúc = mốc câu sau (tối đa 15s)
+    timed = [seg for seg in segments if seg["ts"] is not None]
+    cues = []
+    for i, seg in enumerate(timed):
+        start = remap_seconds(seg["ts"], cut_list)
+        nxt = remap_seconds(timed[i + 1]["ts"], cut_list) if i + 1 < len(timed) else start + 5
+        end = min(max(nxt, start + 1), start + 15)
+        text = MD_BOLD.sub(r"\1", remap_timestamps(seg["text"], cut_list)).strip()
+        cues.append((start, end, seg["speaker"], text))
+    return cues
+
+def fmt_cue_time(sec, sep):
+    ms = int(round(sec * 1000))
+    return f"{ms // 3600000:02d}:{ms // 60000 % 60:02d}:{ms // 1000 % 60:02d}{sep}{ms % 1000:03d}"
+
+def export_srt(transcript, cut_list=None):
+    blocks = [f"{i}\n{fmt_cue_time(a, ',')} --> {fmt_cue_time(b, ',')}\n{f'{sp}: ' if sp else ''}{text}"
+              for i, (a, b, sp, text) in enumerate(timed_cues(transcript.segments, cut_list), 1)]
+    return ("\n\n".join(blocks) + "\n").encode("utf-8")
+
+def export_vtt(transcript, cut_list=None):
+    blocks = [f"{fmt_cue_time(a, '.')} --> {fmt_cue_time(b, '.')}\n{f'<v {sp}>' if sp else ''}{text}"
+              for a, b, sp, text in timed_cues(transcript.segments, cut_list)]
+    return ("WEBVTT\n\n" + "\n\n".join(blocks) + "\n").encode("utf-8")
+
+def export_json(transcript, cut_list=None):
+    segments = [{"start": remap_seconds(seg["ts"], cut_list) if seg["ts"] is not None else None, "speaker": seg["speaker"],
+                 "text": remap_timestamps(seg["text"], cut_list), "section": seg["section"]} for seg in transcript.segments]
+    return json.dumps({"segments": segments}, ensure_ascii=False, indent=2).encode("utf-8")
+
+def export_docx(transcript, cut_list=None):
+    builder = transcript.builders.get("docx")
+    if builder is None or builder.cut_list != cut_list:
+        builder = transcript.builders["docx"] = DocxBuilder(cut_list)
+    return builder.update(transcript.segments).to_bytes()
+
+# định dạng -> (hàm xuất, đuôi file, mime)
+EXPORTERS = {
+    "DOCX": (export_docx, "docx", "application/vnd.openxmlformats-officedocument.wordprocessingml.document"),
+    "SRT": (export_srt, "srt", "application/x-subrip"),
+    "WebVTT": (export_vtt, "vtt", "text/vtt"),
+    "JSON": (export_json, "json", "application/json"),
+}
+
+def run_export(fmt, transcript, cut_list=None):
+    with timed("export", fmt=fmt, segments=len(transcript.segments)):
+        return EXPORTERS[fmt][0](transcript, cut_list)
+
+def get_safe_response(response):
+    try:
+        finish_reason = response.candidates[0].finish_reason
+        if finish_reason in [1, 2]: return response.text
+        elif finish_reason == 3: return "\n\n[CẢNH BÁO: Nội dung bị chặn do Safety.]"
+        elif finish_reason == 4: return "\n\n[DỪNG: Phát hiện nội dung có bản quyền.]"
+        else: return f"\n\n[Lỗi: Finish Reason {finish_reason}]"
+    except: return response.text
+
+def chunk_text(chunk):
+    try: return "".join(p.text for p in chunk.parts if getattr(p, "text", None))
+    except: return ""
+
+def stream_response(response, placeholder, started):
+    # Ghi từng chunk ra placeholder ngay khi tới. Chunk cuối mang finish_reason nên đi qua
+    # get_safe_response để giữ nguyên xử lý Safety / bản quyền (cảnh báo được nối sau phần đã nhận).
+    text, last, ttft = "", None, None
+    for chunk in response:
+        if ttft is None: ttft = time.monotonic() - started
+        if last is not None: text += chunk_text(last)
+        last = chunk
+        placeholder.markdown(text + chunk_text(chunk) + " ▌")
+    if last is not None:
+        try: finish_reason = last.candidates[0].finish_reason
+        except: finish_reason = None
+        if chunk_text(last) or finish_reason not in [1, 2]: text += get_safe_response(last)
+    placeholder.markdown(text)
+    return text, ttft
+
+def read_usage(response, usage):
+    try:
+        meta = response.usage_metadata
+        usage.update(prompt=meta.prompt_token_count, output=meta.candidates_token_count, total=meta.total_token_count,
+                     cached=getattr(meta, "cached_content_token_count", 0) or 0)
+    except: pass
+
+def generate_text(model, contents, placeholder=None, usage=None, **kwargs):
+    # Trả về (text, thời gian tới token đầu tiên). Có placeholder thì chạy stream=True.
+    # Truyền dict `usage` để nhận số token của lần gọi.
+    started = time.monotonic()
+    if placeholder is None:
+        response = model.generate_content(contents, **kwargs)
+        text, ttft = get_safe_response(response), time.monotonic() - started
+    else:
+        response = model.generate_content(contents, stream=True, **kwargs)
+        text, ttft = stream_response(response, placeholder, started)
+    if usage is not None: read_usage(response, usage)
+    return text, ttft
+
+# --- 3. LUỒNG XỬ LÝ (upload → prompt → generate → chạy tiếp → xuất) ---
+TRANSCRIBE_PROMPT = f"""
+{STRICT_RULES}
+NHIỆM VỤ: Gỡ băng NGUYÊN VĂN 100%.
+YÊU CẦU:
+1. Bắt đầu mỗi câu bằng [Phút:Giây].
+2. Viết lại chính xác từng từ.
+3. Định danh: 'Người nói 1', 'Người nói 2'.
+4. Ngôn ngữ: Tiếng Việt.
+"""
+# Thứ tự các mục phân tích (trùng thứ tự checkbox trên giao diện)
+ANALYSIS_SECTIONS = [
+    "TÓM TẮT & HÀNH ĐỘNG", "QUY TRÌNH CHI TIẾT", "PHÂN TÍCH CẢM XÚC", "GÓC BÀ TÁM",
+    "KỊCH BẢN PODCAST", "KỊCH BẢN VIDEO", "MÃ SƠ ĐỒ TƯ DUY (Mermaid)",
+    "BÁO CÁO CHUYÊN SÂU", "BRIEFING DOC", "TIMELINE SỰ KIỆN", "CÂU HỎI THƯỜNG GẶP (FAQ)", "TRẮC NGHIỆM & THẺ NHỚ",
+    "DÀN Ý SLIDE", "BẢNG SỐ LIỆU",
+]
+MAX_CONTINUE_ROUNDS = 40     # trần số vòng chạy tiếp khi không chia đoạn
+
+def new_gen_config():
+    return genai.types.GenerationConfig(max_output_tokens=8192, temperature=0.2)
+
+def build_analysis_prompt(detail_level, sections):
+    return f"{STRICT_RULES}\nNHIỆM VỤ: Phân tích sâu {detail_level} cho các mục sau:\n" + "".join(f"## {h}\n" for h in sections)
+
+def continuation_prompt(anchor):
+    return f"""
+    CONTEXT: Đang gỡ băng dở dang.
+    MỎ NEO: "...{anchor}"
+    NHIỆM VỤ: Tìm mỏ neo, viết tiếp NGUYÊN VĂN đoạn sau. KHÔNG viết lại mỏ neo.
+    """
+
+def is_blocked(text):
+    return "[DỪNG:" in text or "[CẢNH BÁO:" in text
+
+def is_transcript_done(new_text):
+    # Vòng chạy tiếp trả về quá ngắn / báo kết thúc / bị chặn thì dừng
+    return len(new_text) < 50 or "kết thúc" in new_text.lower() or "[DỪNG:" in new_text
+
+def preprocess_sources(sources, prep=None):
+    # Trả về (sources mới, cut list, ghi chú). Chỉ bỏ khoảng lặng khi cả bộ có đúng một file audio/video: nhiều trục
+    # thời gian thì mốc [mm:ss] trong bản gỡ băng không biết thuộc file nào để đổi về gốc, nên chỉ chuyển mã.
+    # prep(name, data, digest, trim) cho phép giao diện thay bằng bản có cache.
+    prep = prep or (lambda name, data, digest, trim: preprocess_audio(name, data, trim=trim))
+    trim = sum((mimetypes.guess_type(n)[0] or "").startswith(("audio/", "video/")) for n, _, _ in sources) == 1
+    prepped, cut_list, notes = [], None, []
+    for name, data, digest in sources:
+        out = None
+        if (mimetypes.guess_type(name)[0] or "").startswith("audio/"):
+            with timed("preprocess", bytes=len(data)): out = prep(name, data, digest, trim)
+        if not out:
+            prepped.append((name, data, digest)); continue
+        new_name, new_data, cuts, pstats = out
+        prepped.append((new_name, new_data, content_digest(new_data)))
+        if trim:
+            cut_list = cuts
+            notes.append(f"🎚️ {name}: {pstats['orig_bytes'] / 1e6:.1f} MB → {pstats['new_bytes'] / 1e6:.1f} MB, "
+                         f"{fmt_ts(pstats['orig_seconds'])} → {fmt_ts(pstats['new_seconds'])} (bỏ {fmt_ts(pstats['orig_seconds'] - pstats['new_seconds'])} im lặng)")
+        else:
+            notes.append(f"🎚️ {name}: {pstats['orig_bytes'] / 1e6:.1f} MB → {pstats['new_bytes'] / 1e6:.1f} MB "
+                         f"(nhiều file audio/video nên giữ nguyên khoảng lặng)")
+    return prepped, cut_list, notes
+
+def transcribe_continuous(pool, models, files, digests, rounds, store=None, on_round=None, max_rounds=MAX_CONTINUE_ROUNDS, cancel=None,
+                          live_box=None):
+    # Gỡ băng kiểu cũ (một lượt + chạy tiếp theo mỏ neo). `rounds` là danh sách các lượt đã có, được nối thêm tại chỗ.
+    # Các vòng chạy tiếp gửi qua context cache để không phải trả lại token của media mỗi vòng.
+    memo = (store, digests) if store else None
+    box = lambda: live_box(f"Vòng {len(rounds) + 1}") if live_box else None
+    if not rounds:
+        text, _, _ = generate_with_failover(pool, models, [TRANSCRIBE_PROMPT] + files, b := box(), memo=memo,
+                                            generation_config=new_gen_config(), safety_settings=SAFETY_SETTINGS)
+        if b: b.close()
+        rounds.append(text)
+        if on_round: on_round(rounds)
+    cache = None
+    while len(rounds) < max_rounds and not is_blocked(rounds[-1]):
+        if cancel is not None and cancel.is_set(): raise Cancelled()
+        c_prompt = continuation_prompt("\n\n".join(rounds)[-500:])
+        cache = ensure_context_cache(pool, models[0], files, digests, cache)
+        text, _, _ = generate_with_context(pool, models, cache, [c_prompt], [c_prompt] + files, b := box(), memo=memo,
+                                           generation_config=new_gen_config(), safety_settings=SAFETY_SETTINGS)
+        if b: b.close()
+        if is_transcript_done(text):
+            if "[DỪNG:" in text: rounds.append(text)
+            break
+        rounds.append(text)
+        if on_round: on_round(rounds)
+    return "\n\n".join(rounds)
+
+def partial_text(state):
+    # Kết quả tạm dựng lại từ state (để giao diện hiện trong lúc job còn chạy)
+    if "windows" in state:
+        return stitch_segments(state["windows"], {int(i): t for i, t in state.get("segments", {}).items()})
+    if "order" in state:
+        return "\n\n".join(state["sections"][h] for h in state["order"] if h in state.get("sections", {}))
+    return "\n\n".join(state.get("rounds", []))
+
+def run_pipeline(sources, pool, models, mode="transcribe", sections=None, detail_level="Sâu", store=None,
+                 preprocess=False, segmented=True, segment_minutes=SEGMENT_MINUTES, segment_workers=SEGMENT_WORKERS,
+                 fanout=True, state=None, on_progress=None, cancel=None, stream=False, live=None):
+    # Chạy trọn một bộ file, không cần giao diện. `state` là dict JSON được cập nhật dần
+    # (đoạn/mục/lượt đã xong, tổng số) để lưu checkpoint và chạy tiếp sau khi bị ngắt.
+    # `live` (dict trong bộ nhớ, không lưu đĩa): trạng thái upload từng file ở live["uploads"], và nếu stream=True
+    # thì phần đang sinh của từng đoạn/mục/lượt ở live["streams"].
+    # Trả về (TranscriptStore, cut list). Còn đoạn/mục lỗi thì raise sau khi đã ghi state; cancel được set thì raise Cancelled.
+    state = {} if state is None else state
+    report = on_progress or (lambda state: None)
+    cut_list = None
+    if preprocess:
+        sources, cut_list, state["prep_notes"] = preprocess_sources(sources)
+        state["cut_list"] = cut_list
+    live_box = None
+    if live is not None:
+        streams = live.setdefault("streams", {})
+        if stream: live_box = lambda label: LiveText(streams, label)
+    g_files = upload_many(sources, pool, (lambda status: live.__setitem__("uploads", status)) if live is not None else None,
+                          cache=get_upload_cache())
+    if live is not None: live.pop("uploads", None)
+    digests = [d for _, _, d in sources]
+    if cancel is not None and cancel.is_set(): raise Cancelled()
+
+    if mode == "transcribe":
+        job = prepare_segment_job(sources, g_files, pool, segment_minutes) if segmented else None
+        if job:
+            job["done"] = {int(i): t for i, t in state.get("segments", {}).items()}
+            state["windows"], state["total"] = job["windows"], len(job["windows"])
+            def save_segments(job):
+                if len(job["done"]) == len(state.get("segments", {})): return
+                state["segments"] = {str(i): t for i, t in job["done"].items()}; report(state)
+            report(state)
+            run_segment_job(job, pool, models, new_gen_config(), save_segments, segment_workers, store, cancel, live_box)
+            if job["errors"]: raise RuntimeError(f"{len(job['errors'])} đoạn lỗi: " + "; ".join(job["errors"].values()))
+            with timed("stitch"): text = stitch_segments(job["windows"], job["done"])
+        else:
+            for k in ("windows", "segments", "total"): state.pop(k, None)   # kế hoạch chia đoạn cũ (nếu có) không còn dùng
+            rounds = state.setdefault("rounds", [])
+            text = transcribe_continuous(pool, models, g_files, digests, rounds, store, lambda r: report(state), cancel=cancel,
+                                         live_box=live_box)
+    elif not fanout:
+        rounds = state.setdefault("rounds", [])
+        if not rounds:
+            box = live_box("Phân tích") if live_box else None
+            rounds.append(generate_with_failover(pool, models, [build_analysis_prompt(detail_level, sections or ANALYSIS_SECTIONS[:1])] + g_files,
+                                                 box, memo=(store, digests) if store else None,
+                                                 generation_config=new_gen_config(), safety_settings=SAFETY_SETTINGS)[0])
+            if box: box.close()
+            report(state)
+        text = rounds[0]
+    else:
+        sections = sections or ANALYSIS_SECTIONS[:1]
+        state["order"], state["total"] = list(sections), len(sections)
+        job = {"sections": sections, "detail": detail_level, "files": g_files, "digests": digests,
+               "results": dict(state.get("sections", {})), "errors": {}}
+        def save_sections(h, job):
+            state["sections"] = dict(job["results"]); report(state)
+        report(state)
+        run_sections(job, pool, models, new_gen_config(), save_sections, store=store, cancel=cancel, live_box=live_box)
+        if job["errors"]: raise RuntimeError(f"{len(job['errors'])} mục lỗi: " + "; ".join(job["errors"].values()))
+        text = merge_sections(job)
+    return TranscriptStore(text), cut_list
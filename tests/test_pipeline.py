@@ -0,0 +1,117 @@
+# Kiểm tra các hàm thuần của pipeline (không gọi API): python -m pytest tests
+import os
+import sys
+import time
+from types import SimpleNamespace
+import pytest
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from pipeline import (KeyPool, TranscriptIndex, TranscriptStore, generate_with_failover, remap_seconds, remap_timestamps,
+                      split_utterances, stitch_segments)
+
+WINDOWS = [{"start": 0, "end": 600}, {"start": 600, "end": 1200}]
+
+# --- Ghép đoạn gỡ băng song song ---
+def test_split_utterances_bold_and_bullet_stamps():
+    text = "**[09:50] Người nói 1:** a\ntiếp\n- [10:05] Người nói 2: b\n[10:10] c"
+    assert split_utterances(text) == [[590, "**[09:50] Người nói 1:** a\ntiếp"], [605, "- [10:05] Người nói 2: b"], [610, "[10:10] c"]]
+
+def test_stitch_segments_bold_stamps_follow_owned_range():
+    texts = {0: "**[09:50] Người nói 1:** a\n**[10:05] Người nói 2:** b",
+             1: "**[09:50] Người nói 1:** a\n**[15:00] Người nói 2:** c"}
+    assert stitch_segments(WINDOWS, texts).split("\n") == ["**[09:50] Người nói 1:** a", "**[15:00] Người nói 2:** c"]
+
+def test_stitch_segments_bulleted_stamps_dedupe_overlap():
+    texts = {0: "- [09:58] Người nói 1: xin chào\n- [10:02] Người nói 2: vâng",
+             1: "- [10:02] Người nói 2: vâng\n- [10:30] Người nói 1: tiếp tục"}
+    assert stitch_segments(WINDOWS, texts).split("\n") == ["- [09:58] Người nói 1: xin chào", "- [10:02] Người nói 2: vâng",
+                                                         "- [10:30] Người nói 1: tiếp tục"]
+
+def test_stitch_segments_missing_window_placeholder():
+    out = stitch_segments(WINDOWS, {1: "[10:30] x"}).split("\n")
+    assert out[0].startswith("[... Đoạn") and out[1] == "[10:30] x"
+
+# --- Phân tích dòng của TranscriptStore ---
+def parsed(line):
+    seg = TranscriptStore(line).segments[0]
+    return seg["ts"], seg["speaker"], seg["text"]
+
+def test_transcript_store_bold_line():
+    assert parsed("**[00:01] Người nói 1:** hi") == (1, "Người nói 1", "hi")
+    assert parsed("**[00:01]** **Người nói 1:** hi") == (1, "Người nói 1", "hi")
+    assert parsed("[00:01] **Người nói 1**: hi") == (1, "Người nói 1", "hi")
+
+def test_transcript_store_bulleted_line():
+    assert parsed("- [01:02:03] Người nói 2: xin chào") == (3723, "Người nói 2", "xin chào")
+    assert parsed("* **[00:05] Người nói 1:** vâng") == (5, "Người nói 1", "vâng")
+
+def test_transcript_store_bare_line_keeps_inner_bold():
+    assert parsed("[00:10] Người nói 1: **rất** quan trọng") == (10, "Người nói 1", "**rất** quan trọng")
+    assert parsed("[00:10] không có người nói") == (10, None, "không có người nói")
+
+def test_stitch_segments_keeps_repeated_lines_outside_overlap():
+    texts = {0: "[00:10] Người nói 1: Vâng.\n[00:30] Người nói 1: Vâng.",
+             1: "[10:05] Người nói 1: Vâng."}
+    assert stitch_segments(WINDOWS, texts).split("\n") == ["[00:10] Người nói 1: Vâng.", "[00:30] Người nói 1: Vâng.",
+                                                         "[10:05] Người nói 1: Vâng."]
+
+# --- Tìm đoạn trích cho chat ---
+MEETING = "[00:05] Người nói 1: Chào mọi người\n[00:20] Người nói 2: Giá bán quý này tăng mười phần trăm\n[00:40] Người nói 1: Đội kỹ thuật báo cáo tiến độ"
+
+def test_transcript_index_folds_diacritics():
+    hits, coverage = TranscriptIndex().update(TranscriptStore(MEETING)).search("GIA BAN")
+    assert hits[0]["ts"] == 20 and coverage == 1.0
+
+def test_transcript_index_coverage_counts_missing_keywords():
+    hits, coverage = TranscriptIndex().update(TranscriptStore(MEETING)).search("giá bán của công ty khác")
+    assert [h["ts"] for h in hits] == [20] and 0 < coverage < 1
+    assert TranscriptIndex().update(TranscriptStore(MEETING)).search("ngân sách") == ([], 0.0)
+
+def test_transcript_index_incremental_update():
+    store, index = TranscriptStore(MEETING), TranscriptIndex()
+    index.update(store)
+    store.append("\n[01:00] Người nói 2: Ngân sách marketing giữ nguyên")
+    assert len(index.update(store).docs) == 4
+    assert [h["ts"] for h in index.search("ngân sách")[0]] == [60]
+    store.replace("[00:01] Người nói 1: Ngân sách mới")
+    assert len(index.update(store).docs) == 1 and index.search("ngân sách")[0][0]["ts"] == 1
+
+# --- Đổi mốc thời gian sau khi cắt khoảng lặng ---
+CUTS = [[0.0, 10.0, 0.0], [30.0, 50.0, 10.0], [100.0, 110.0, 30.0]]
+
+def test_remap_seconds():
+    assert [remap_seconds(t, CUTS) for t in (0, 5, 10, 15, 30, 35, 40)] == [0, 5, 30, 35, 100, 105, 110]
+    assert remap_seconds(12, None) == 12
+
+def test_remap_timestamps():
+    assert remap_timestamps("[00:05] a\n**[00:15] Người nói 1:** b\n[00:35] c", CUTS) == "[00:05] a\n**[00:35] Người nói 1:** b\n[01:45] c"
+    assert remap_timestamps("[00:15] a", None) == "[00:15] a"
+
+# --- KeyPool: nghỉ sau 429 và chuyển key ---
+def test_key_pool_acquire_skips_cooldown():
+    pool = KeyPool(["k1", "k2"])
+    assert pool.acquire("m") == "k1"
+    pool.release("k1", "m", cooldown=0.05)
+    assert pool.acquire("m") == "k2" and pool.acquire("m", exclude={"k2"}) is None
+    assert pool.acquire("m", only="k1") is None and pool.acquire("other", only="k1") == "k1"
+    time.sleep(0.06)
+    assert pool.acquire("m", only="k1") == "k1"
+
+class StubPool(KeyPool):
+    # Không gọi API: k1 luôn hết quota, key khác trả lời bằng tên của nó
+    def bind_model(self, key, model_name, **kwargs):
+        def generate_content(contents, **kwargs):
+            if key == "k1": raise Exception("429 Resource exhausted, retry in 30s")
+            return SimpleNamespace(text=f"ok {key}")
+        return SimpleNamespace(generate_content=generate_content)
+
+def test_generate_with_failover_moves_to_next_key():
+    pool = StubPool(["k1", "k2"])
+    text, _, model = generate_with_failover(pool, ["m"], ["xin chào"])
+    assert (text, model) == ("ok k2", "m")
+    assert pool.acquire("m", only="k1") is None
+
+def test_generate_with_failover_keeps_files_on_owner_key():
+    pool, f = StubPool(["k1", "k2"]), SimpleNamespace(name="files/a")
+    pool.set_file_owner([f], "k1")
+    with pytest.raises(Exception, match="^429"):
+        generate_with_failover(pool, ["m"], ["xin chào", f])